@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+mock_pentaho
+------------
+
+A stand in for the Pentaho BI server endpoints that pentaho_saiku_adhoc_run.py calls -
+the Saiku Adhoc (/content/saiku-adhoc/rest/...) and Saiku Analytics (/content/saiku/admin/...)
+lookup, create, execute and export calls, and the SolutionRepositoryService document.
+
+The export size of a report is taken from its name, so one server can serve every size eg:
+bench-1K.adhoc, bench-10M-3.saiku or bench-1G.adhoc - names without a size get --export-size.
+Exports are generated as CSV rows on the fly, so even 1 GB exports need no memory or disk.
+
+SYNOPSIS:
+
+  python mock_pentaho.py --port=8765 --latency=0.01 --execute-latency=0.2
+
+The URL to use as --url is written to stdout when the server is ready (--port=0 picks a free port).
+
+
+Copyright (C) Piers Harding 2014 and beyond, All rights reserved
+
+mock_pentaho.py is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+"""
+
+
+import sys
+import re
+from optparse import OptionParser
+import logging
+import time
+import json
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+# a size in bytes from a string like 512, 64K, 10M or 1G
+def parse_size(size):
+    m = re.match(r'^(\d+)([KMG]?)B?$', str(size).strip().upper())
+    if not m:
+        raise ValueError("invalid size: " + str(size))
+    return int(m.group(1)) * SIZE_UNITS[m.group(2)]
+
+
+# the export size given in a report name eg: bench-10M-3.adhoc
+def name_size(name, default):
+    m = re.search(r'-(\d+[KMG]?)(?:-\d+)?\.(?:adhoc|saiku)', name, re.I)
+    return parse_size(m.group(1)) if m else default
+
+
+# CSV export rows generated in blocks up to size bytes
+def export_chunks(size, chunk_size=65536):
+    row = b'"row",12345.67,"some text for the export"\n'
+    block = row * (chunk_size // len(row) + 1)
+    header = b'"label","value","description"\n'
+    if size <= len(header):
+        yield header[:size]
+        return
+    yield header
+    left = size - len(header)
+    while left > 0:
+        chunk = block[:min(left, chunk_size)]
+        left -= len(chunk)
+        yield chunk
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # the status line and headers go out in one packet, or delayed ACKs add 40ms to calls
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send(self, body, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self, execute=False):
+        options = self.server.options
+        time.sleep(options.latency + (options.execute_latency if execute else 0))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        path = url.path
+        options = self.server.options
+        self.delay('/report/' in path or '/result/' in path)
+
+        # Saiku Adhoc
+        m = re.match(r'.*/content/saiku-adhoc/rest/repository/query/(.+)$', path)
+        if m:
+            name = urllib.unquote(m.group(1))
+            definition = {'name': name, 'newname': name, 'lastModified': 1388534400000,
+                          'solution': params.get('solution', [''])[0], 'path': params.get('path', [''])[0],
+                          'action': name, 'overwrite': True,
+                          'clientModelSelection': 'bench/metadata.xmi/BV_BENCH/Bench',
+                          'description': 'export-size=%d' % name_size(name, options.export_size),
+                          'columns': [{'name': 'label'}, {'name': 'value'}, {'name': 'description'}],
+                          'filters': [], 'parameters': []}
+            return self.send(json.dumps(definition))
+        if re.match(r'.*/content/saiku-adhoc/rest/query/[^/]+/report/\d+$', path):
+            return self.send(json.dumps({'data': [], 'pageCount': 1}))
+        m = re.match(r'.*/content/saiku-adhoc/rest/export/([^/]+)/(\w+)$', path)
+        if m:
+            return self.export(m.group(1), m.group(2))
+
+        # Saiku Analytics
+        if re.match(r'.*/content/saiku/admin/pentahorepository2/resource$', path):
+            name = urllib.unquote(params.get('file', [''])[0]).split('/')[-1]
+            return self.send('<?xml version="1.0" encoding="UTF-8"?>\n<Query name="%s" type="QM">'
+                             '<MDX>SELECT {[Measures].[Value]} ON COLUMNS FROM [Bench]</MDX>'
+                             '<Properties>export-size=%d</Properties></Query>' %
+                             (name, name_size(name, options.export_size)), 'text/xml')
+        if re.match(r'.*/content/saiku/admin/query/[^/]+/result/flattened$', path):
+            limit = int(params.get('limit', ['0'])[0])
+            rows = min(limit, options.rows) if limit else options.rows
+            return self.send(json.dumps({'height': rows, 'width': 3, 'totalRows': options.rows,
+                                         'cellset': [[{'value': str(i)}] * 3 for i in range(rows)]}))
+        m = re.match(r'.*/content/saiku/admin/query/([^/]+)/export/(\w+)/flattened$', path)
+        if m:
+            return self.export(m.group(1), m.group(2))
+
+        if path.endswith('/SolutionRepositoryService'):
+            files = ''.join('<file isDirectory="false" name="bench-%d.adhoc" lastModifiedDate="1388534400000"/>' % i
+                            for i in range(options.reports))
+            return self.send('<?xml version="1.0" encoding="UTF-8"?>\n<repository path="/pentaho-solutions">'
+                             '<file isDirectory="true" name="bench" lastModifiedDate="1388534400000">%s</file>'
+                             '</repository>' % files, 'text/xml')
+
+        self.send('not found', 'text/plain', 404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.delay()
+        m = re.match(r'.*/content/saiku(?:-adhoc/rest|/admin)/query/([^/]+)$', url.path)
+        if not m:
+            return self.send('not found', 'text/plain', 404)
+        # the export size travels with the definition into the report instance
+        size = re.search(r'export-size(?:=|%3D)(\d+)', body)
+        with self.server.lock:
+            self.server.instances[m.group(1)] = int(size.group(1)) if size else self.server.options.export_size
+        self.send(json.dumps({'uniqueId': m.group(1)}))
+
+    def export(self, rep_uuid, output_type):
+        with self.server.lock:
+            size = self.server.instances.get(rep_uuid)
+        if size is None:
+            return self.send('no such query: ' + rep_uuid, 'text/plain', 404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.ms-excel' if output_type == 'xls' else
+                         'application/pdf' if output_type == 'pdf' else 'text/csv')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        for chunk in export_chunks(size):
+            self.wfile.write(chunk)
+
+
+class MockPentaho(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, options):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockHandler)
+        self.options = options
+        self.instances = {}
+        self.lock = threading.Lock()
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", default='127.0.0.1', type="string",
+                          help="Address to listen on", metavar="HOST")
+    parser.add_option("--port", dest="port", default=0, type="int",
+                          help="Port to listen on (0 for any free port)", metavar="PORT")
+    parser.add_option("--latency", dest="latency", default=0.0, type="float",
+                          help="Seconds added to every request", metavar="LATENCY")
+    parser.add_option("--execute-latency", dest="execute_latency", default=0.0, type="float",
+                          help="Further seconds added to query execution", metavar="EXECUTE_LATENCY")
+    parser.add_option("--export-size", dest="export_size", default='1M', type="string",
+                          help="Export size for reports with no size in their name eg: 1K, 10M, 1G", metavar="SIZE")
+    parser.add_option("--rows", dest="rows", default=1000, type="int",
+                          help="Row count reported for Saiku Analytics queries", metavar="ROWS")
+    parser.add_option("--reports", dest="reports", default=10, type="int",
+                          help="Number of reports listed in the repository document", metavar="REPORTS")
+    parser.add_option("-d", "--debug", dest="debug", default=False, action="store_true",
+                  help="Debug logging", metavar="DEBUG")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if options.debug else logging.INFO),
+                        format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+    try:
+        options.export_size = parse_size(options.export_size)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    server = MockPentaho((options.host, options.port), options)
+    print("http://%s:%d/pentaho" % server.server_address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+pam_startup_bench
+-----------------
+
+Time how long pentaho_pam.py takes to start up and give its answer, the way pam_exec runs
+it, for the logins that should never need the database:
+
+  not-auth          PAM_TYPE is not auth
+  no-user           PAM_USER is not set
+  no-password       nothing on stdin
+  no-local-account  PAM_USER has no local (NSS) account
+  cached            a login remembered in the verification cache
+
+The runs use a private cache directory and a daemon socket that nothing listens on.
+Compare with another version of the script (eg: one taken from git) with --compare:
+
+  git show HEAD~5:pentaho_pam.py > /tmp/pentaho_pam_old.py
+  python pam_startup_bench.py --runs=50 --compare=/tmp/pentaho_pam_old.py
+
+
+Copyright (C) Piers Harding 2014 and beyond, All rights reserved
+
+pam_startup_bench.py is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+"""
+
+
+import sys, os
+from optparse import OptionParser
+import logging
+import time
+import subprocess
+import tempfile
+import shutil
+import pwd
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), 'pentaho_pam.py')
+
+PASSWORD = 'bench-password'
+
+
+# the environment and stdin of each scenario
+def scenarios(work):
+    user = pwd.getpwuid(os.getuid()).pw_name
+    base = dict(os.environ, PENTAHO_PAM_CACHE=os.path.join(work, 'cache'),
+                PENTAHO_PAM_SOCKET=os.path.join(work, 'none.sock'))
+    return [('not-auth', dict(base, PAM_TYPE='account', PAM_USER=user), PASSWORD),
+            ('no-user', dict(base, PAM_TYPE='auth'), PASSWORD),
+            ('no-password', dict(base, PAM_TYPE='auth', PAM_USER=user), ''),
+            ('no-local-account', dict(base, PAM_TYPE='auth', PAM_USER='no-such-user-for-bench'), PASSWORD),
+            ('cached', dict(base, PAM_TYPE='auth', PAM_USER=user), PASSWORD)]
+
+
+# the wall time in ms of each run of a script
+def time_runs(script, env, stdin, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, script], env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.communicate(stdin + '\0')
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return times
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("--script", dest="script", default=SCRIPT, type="string",
+                          help="pentaho_pam.py to time", metavar="SCRIPT")
+    parser.add_option("--compare", dest="compare", default=None, type="string",
+                          help="Another pentaho_pam.py to compare with", metavar="SCRIPT")
+    parser.add_option("--runs", dest="runs", default=20, type="int",
+                          help="Runs of each scenario", metavar="RUNS")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+    if options.runs < 1:
+        logging.error("Runs must be at least 1")
+        sys.exit(1)
+
+    scripts = [options.script] + ([options.compare] if options.compare else [])
+    work = tempfile.mkdtemp(prefix='pam_startup_bench-')
+    try:
+        # the cached scenario needs a remembered login
+        import pentaho_pam
+        cache = pentaho_pam.LoginCache(os.path.join(work, 'cache'))
+        cache.remember(pwd.getpwuid(os.getuid()).pw_name, PASSWORD)
+
+        logging.info("%-18s %s  (median/p95 ms)" % ('scenario', ''.join("%24s" % os.path.basename(s)[-24:] for s in scripts)))
+        for name, env, stdin in scenarios(work):
+            results = []
+            for script in scripts:
+                times = time_runs(script, env, stdin, options.runs)
+                results.append("%24s" % ("%.1f/%.1f" % (times[len(times) // 2],
+                                                        times[min(len(times) - 1, int(len(times) * 0.95))])))
+            logging.info("%-18s %s" % (name, ''.join(results)))
+    finally:
+        shutil.rmtree(work, True)
+
+
+if __name__ == "__main__":
+    main()
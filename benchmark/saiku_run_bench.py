@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+saiku_run_bench
+---------------
+
+Benchmark pentaho_saiku_adhoc_run.py against the local mock Pentaho server (mock_pentaho.py).
+
+For each export size, the runner is measured in three modes:
+
+  single      - --runs separate runner processes, one report each
+  batch       - one --batch run of --reports reports with one worker
+  concurrent  - the same batch with --workers workers
+
+and the reports/sec, peak RSS of the runner process and the median and 95th percentile
+latency of each query phase (from the runner's --timings) are logged.  Half of the
+reports are Saiku Adhoc and half Saiku Analytics queries.  Each generated report is
+deleted as soon as it is complete, so even 1G runs need little disk space.
+
+SYNOPSIS:
+
+  python saiku_run_bench.py --sizes=1K,1M,100M --save=baseline.json
+
+  python saiku_run_bench.py --sizes=1K,1M,100M --baseline=baseline.json --tolerance=20
+
+With --baseline the run exits with 1 if the reports/sec of any mode has dropped, or its
+peak RSS has grown, by more than --tolerance percent.  Baselines are only comparable
+when taken on the same machine with the same options.
+
+
+Copyright (C) Piers Harding 2014 and beyond, All rights reserved
+
+saiku_run_bench.py is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+"""
+
+
+import sys, os
+from optparse import OptionParser
+import logging
+import time
+import json
+import subprocess
+import tempfile
+import shutil
+import threading
+
+from mock_pentaho import parse_size
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RUNNER = os.path.join(os.path.dirname(BENCH_DIR), 'pentaho_saiku_adhoc_run.py')
+MODES = ['single', 'batch', 'concurrent']
+
+
+# start the mock server and return it with its URL
+def start_mock(options):
+    args = [sys.executable, os.path.join(BENCH_DIR, 'mock_pentaho.py'),
+            '--latency=' + str(options.latency),
+            '--execute-latency=' + str(options.execute_latency)]
+    mock = subprocess.Popen(args, stdout=subprocess.PIPE)
+    url = mock.stdout.readline().strip()
+    if not url:
+        raise RuntimeError("mock Pentaho server did not start")
+    return mock, url
+
+
+# run the runner to completion - returns the wall time and the peak RSS (KB) of the process
+def run_runner(args, stdin=None):
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, RUNNER] + args, stdin=stdin, stdout=devnull, stderr=devnull)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    elapsed = time.time() - start
+    devnull.close()
+    if status:
+        raise RuntimeError("runner failed: " + ' '.join(args[-4:]))
+    return elapsed, rusage.ru_maxrss
+
+
+# a report name for the mock server - alternating Adhoc and Analytics queries
+def report_name(size, i):
+    return 'bench-%s-%d.%s' % (size, i, 'adhoc' if i % 2 == 0 else 'saiku')
+
+
+# median and 95th percentile of each phase latency in a runner --timings file
+def phase_latencies(timings):
+    seconds = {}
+    for line in open(timings):
+        for phase in json.loads(line)['phases']:
+            seconds.setdefault(phase['phase'], []).append(phase['seconds'])
+    latencies = {}
+    for phase, times in seconds.items():
+        times.sort()
+        latencies[phase] = {'median': times[len(times) // 2],
+                            'p95': times[min(len(times) - 1, int(len(times) * 0.95))]}
+    return latencies
+
+
+# run one mode for one export size
+def run_mode(mode, size, url, options):
+
+    work = tempfile.mkdtemp(prefix='saiku_run_bench-')
+    try:
+        timings = os.path.join(work, 'timings.json')
+        common = ['--url=' + url, '--user=bench', '--passwd=bench', '--solution=bench',
+                  '--type=csv', '--no-cache', '--no-daemon', '--no-index',
+                  '--spool-dir=' + work, '--cache-dir=' + os.path.join(work, 'cache'),
+                  '--timings=' + timings]
+
+        if mode == 'single':
+            reports = options.runs
+            elapsed = 0.0
+            rss = 0
+            for i in range(reports):
+                seconds, peak = run_runner(common + ['--generate', '--name=' + report_name(size, i)])
+                elapsed += seconds
+                rss = max(rss, peak)
+                clear_spool(work)
+        else:
+            reports = options.reports
+            manifest = os.path.join(work, 'manifest.csv')
+            fh = open(manifest, 'w')
+            for i in range(reports):
+                fh.write(report_name(size, i) + ',bench,,csv\n')
+            fh.close()
+            workers = options.workers if mode == 'concurrent' else 1
+            done = threading.Event()
+            sweeper = threading.Thread(target=sweep_spool, args=(work, done))
+            sweeper.start()
+            try:
+                elapsed, rss = run_runner(common + ['--batch=' + manifest, '--workers=' + str(workers),
+                                                    '--max-per-server=' + str(workers)])
+            finally:
+                done.set()
+                sweeper.join()
+
+        return {'reports': reports,
+                'seconds': round(elapsed, 3),
+                'reports_per_sec': round(reports / elapsed, 3),
+                'peak_rss_kb': rss,
+                'phases': phase_latencies(timings)}
+    finally:
+        shutil.rmtree(work, True)
+
+
+# remove the generated reports - large exports would soon fill the disk.  Reports
+# only get their final name once complete (until then the name is held by an empty
+# file), so those can be removed while a batch is still running
+def clear_spool(work):
+    for name in os.listdir(work):
+        path = os.path.join(work, name)
+        try:
+            if name.startswith('bench-') and os.path.getsize(path):
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+# clear the spool directory every fraction of a second until done is set, so a
+# batch never holds more than the reports in flight on disk
+def sweep_spool(work, done):
+    while not done.wait(0.2):
+        clear_spool(work)
+    clear_spool(work)
+
+
+# compare the results with a baseline - returns the regressions
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if not base:
+            logging.info("%-20s no baseline" % key)
+            continue
+        rate = 100.0 * (result['reports_per_sec'] - base['reports_per_sec']) / base['reports_per_sec']
+        rss = 100.0 * (result['peak_rss_kb'] - base['peak_rss_kb']) / base['peak_rss_kb']
+        logging.info("%-20s reports/sec %+6.1f%%  peak RSS %+6.1f%%" % (key, rate, rss))
+        if rate < -tolerance:
+            regressions.append("%s reports/sec %.3f is %.1f%% below the baseline %.3f" %
+                               (key, result['reports_per_sec'], -rate, base['reports_per_sec']))
+        if rss > tolerance:
+            regressions.append("%s peak RSS %d KB is %.1f%% above the baseline %d KB" %
+                               (key, result['peak_rss_kb'], rss, base['peak_rss_kb']))
+    return regressions
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("--sizes", dest="sizes", default='1K,1M,10M', type="string",
+                          help="Comma separated export sizes to benchmark eg: 1K,1M,100M,1G", metavar="SIZES")
+    parser.add_option("--modes", dest="modes", default=','.join(MODES), type="string",
+                          help="Comma separated modes to run - single, batch and/or concurrent", metavar="MODES")
+    parser.add_option("--runs", dest="runs", default=5, type="int",
+                          help="Runner processes started in single mode", metavar="RUNS")
+    parser.add_option("--reports", dest="reports", default=20, type="int",
+                          help="Reports in the batch and concurrent manifests", metavar="REPORTS")
+    parser.add_option("--workers", dest="workers", default=8, type="int",
+                          help="Runner workers in concurrent mode", metavar="WORKERS")
+    parser.add_option("--latency", dest="latency", default=0.01, type="float",
+                          help="Seconds the mock server adds to every request", metavar="LATENCY")
+    parser.add_option("--execute-latency", dest="execute_latency", default=0.05, type="float",
+                          help="Further seconds the mock server adds to query execution", metavar="EXECUTE_LATENCY")
+    parser.add_option("--save", dest="save", default=None, type="string",
+                          help="Save the results as a baseline to this file", metavar="FILE")
+    parser.add_option("--baseline", dest="baseline", default=None, type="string",
+                          help="Fail if the results regress from this baseline", metavar="FILE")
+    parser.add_option("--tolerance", dest="tolerance", default=20.0, type="float",
+                          help="Percentage regression allowed against the baseline", metavar="PERCENT")
+    parser.add_option("-d", "--debug", dest="debug", default=False, action="store_true",
+                  help="Debug logging", metavar="DEBUG")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if options.debug else logging.INFO),
+                        format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+
+    sizes = [s.strip().upper() for s in options.sizes.split(',') if s.strip()]
+    modes = [m.strip() for m in options.modes.split(',') if m.strip()]
+    try:
+        for size in sizes:
+            parse_size(size)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    if [m for m in modes if not m in MODES]:
+        logging.error("Modes must be single, batch or concurrent")
+        sys.exit(1)
+    if options.runs < 1 or options.reports < 1 or options.workers < 1:
+        logging.error("Runs, reports and workers must be at least 1")
+        sys.exit(1)
+
+    baseline = None
+    if options.baseline:
+        try:
+            baseline = json.load(open(options.baseline))['results']
+        except (IOError, ValueError, KeyError) as e:
+            logging.error("Could not read baseline %s: %s" % (options.baseline, str(e)))
+            sys.exit(1)
+
+    mock, url = start_mock(options)
+    results = {}
+    try:
+        logging.info("%-20s %8s %9s %12s %12s %s" % ('mode', 'reports', 'seconds', 'reports/sec', 'peak RSS KB',
+                                                   'phase median/p95 seconds'))
+        for size in sizes:
+            for mode in modes:
+                key = mode + ' ' + size
+                try:
+                    result = run_mode(mode, size, url, options)
+                except RuntimeError as e:
+                    logging.error("%s: %s" % (key, str(e)))
+                    sys.exit(1)
+                results[key] = result
+                phases = ' '.join("%s %.3f/%.3f" % (p, l['median'], l['p95'])
+                                  for p, l in sorted(result['phases'].items()))
+                logging.info("%-20s %8d %9.3f %12.3f %12d %s" % (key, result['reports'], result['seconds'],
+                                                                result['reports_per_sec'], result['peak_rss_kb'], phases))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    if options.save:
+        fh = open(options.save, 'w')
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'options': {'runs': options.runs, 'reports': options.reports, 'workers': options.workers,
+                               'latency': options.latency, 'execute_latency': options.execute_latency},
+                   'results': results}, fh, indent=2, sort_keys=True)
+        fh.close()
+        logging.info("baseline saved to " + options.save)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            logging.error("regression: " + regression)
+        if regressions:
+            sys.exit(1)
+        logging.info("no regressions against " + options.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ from flask.ext.login import (LoginManager, current_user, login_required,
 from flask.ext.sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.mysql import BIT
 import base64
+import threading
+import time
 
 class User(UserMixin):
     def __init__(self, name, fullname, active=True):
@@ -60,6 +62,45 @@ class DBUser(db.Model):
         return '<User %r>' % self.USERNAME
 
 
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 1000
+
+
+class UserCache(object):
+    """The logged in users loaded for each request, kept for USER_CACHE_TTL seconds so
+    page loads do not each go to the database.  Each process has its own cache, so a
+    change made elsewhere shows within the TTL - changes made here invalidate at once."""
+
+    def __init__(self, ttl=USER_CACHE_TTL, size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        now = time.time()
+        with self.lock:
+            cached = self.users.get(username)
+        if cached and cached[0] > now:
+            return cached[1]
+        u = db.session.query(DBUser.USERNAME, DBUser.DESCRIPTION).filter_by(USERNAME=username).first()
+        # a deleted user is remembered too, as None - which logs the session out
+        user = User(u.USERNAME, u.DESCRIPTION) if u else None
+        with self.lock:
+            if len(self.users) >= self.size:
+                for name in [n for n, c in self.users.items() if c[0] <= now] or list(self.users):
+                    del self.users[name]
+            self.users[username] = (now + self.ttl, user)
+        return user
+
+    def invalidate(self, username):
+        with self.lock:
+            self.users.pop(username, None)
+
+
+user_cache = UserCache()
+
+
 SECRET_KEY = "yeah, not actually a secret"
 DEBUG = True
 
@@ -74,8 +115,7 @@ login_manager.refresh_view = "reauth"
 
 @login_manager.user_loader
 def load_user(username):
-    u = DBUser.query.get(username)
-    return User(u.USERNAME, u.DESCRIPTION)
+    return user_cache.get(username)
 
 
 login_manager.setup_app(app)
@@ -101,6 +141,7 @@ def changepasswd():
                 # we can now change the password
                 u.PASSWORD = base64.b64encode(new1)
                 db.session.commit()
+                user_cache.invalidate(u.USERNAME)
                 flash("Password changed!")
                 return redirect(url_for("index"))
             else:
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PAM User Authentication Daemon
+==============================
+A resident companion to pentaho_pam.py - it keeps a pool of connections to the Pentaho
+hibernate database open, and checks the logins that pentaho_pam.py hands to it over a
+unix socket, so a login no longer pays for connecting to the database.
+
+Run it as root (eg: from an init script or systemd unit):
+
+  python /path/to/pentaho_pamd.py --socket=/var/run/pentaho_pam.sock --workers=8
+
+The socket is created owned by root with mode 0600, and only root (which pam_exec runs
+pentaho_pam.py as) or the daemon's own user may ask it to check a login.  The database
+is configured by SQLALCHEMY_DATABASE_URI in pentaho_pam.py, and logins are cached just
+as they are by pentaho_pam.py (see CACHE_DIR there).
+
+"""
+
+import os
+import sys
+import logging
+import json
+import socket
+import struct
+import threading
+import signal
+import SocketServer
+from optparse import OptionParser
+
+import pentaho_pam
+
+logger = logging.getLogger('pentaho_pamd')
+
+# struct ucred from SO_PEERCRED - not defined by the socket module on Python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class PamHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.allowed(self.request):
+            return
+        line = self.rfile.readline()
+        if not line:
+            # a probe to see if the daemon is alive
+            return
+        try:
+            request = json.loads(line)
+            username = request['user']
+            password = request['password'].encode('utf-8')
+        except (ValueError, KeyError, TypeError):
+            logger.warn('bad request')
+            return
+        timings = {}
+        try:
+            with self.server.workers:
+                ok, reason = pentaho_pam.authenticate(username, password, self.server.cache, timings=timings)
+        except Exception as e:
+            # a database error fails the login, never the daemon
+            logger.exception('login check for %s failed' % username)
+            ok, reason = False, 'error: ' + str(e)
+        logger.info('login for user: %s %s' % (username, 'successful' if ok else 'failed: ' + reason))
+        try:
+            self.wfile.write(json.dumps({'ok': ok, 'reason': reason, 'timings': timings}) + "\n")
+        except socket.error as e:
+            logger.warn('client went away before its reply could be sent: ' + str(e))
+
+
+class PamDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def allowed(self, sock):
+        """Only root and the daemon's own user may check logins."""
+        try:
+            pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+        except socket.error:
+            return False
+        if uid in (0, os.getuid()):
+            return True
+        logger.warn('refused connection from uid %d (pid %d)' % (uid, pid))
+        return False
+
+
+def serve(options):
+
+    if os.path.exists(options.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(options.socket)
+            probe.close()
+            logger.error('pentaho_pamd is already listening on: ' + options.socket)
+            sys.exit(1)
+        except socket.error:
+            # left behind by a daemon that died
+            probe.close()
+            os.unlink(options.socket)
+
+    # the socket carries passwords, so only its owner may connect
+    umask = os.umask(0o077)
+    try:
+        server = PamDaemon(options.socket, PamHandler)
+    finally:
+        os.umask(umask)
+    server.workers = threading.BoundedSemaphore(options.workers)
+    server.cache = pentaho_pam.LoginCache()
+
+    # connections are checked out of the pool for each login, and recycled before
+    # MySQL's wait_timeout can drop them
+    pentaho_pam.setup_pool(options.workers, options.pool_recycle)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info('pentaho_pamd listening on %s with %d workers' % (options.socket, options.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("--socket", dest="socket", default=os.environ.get('PENTAHO_PAM_SOCKET', pentaho_pam.PAMD_SOCKET),
+                          type="string", help="Unix socket to listen on", metavar="SOCKET")
+    parser.add_option("-w", "--workers", dest="workers", default=8, type="int",
+                          help="Logins checked at once - and database connections in the pool", metavar="WORKERS")
+    parser.add_option("--pool-recycle", dest="pool_recycle", default=3600, type="int",
+                          help="Seconds before a pooled database connection is replaced", metavar="SECONDS")
+    parser.add_option("--log", dest="log", default='/tmp/pentaho_pamd.log', type="string",
+                          help="Log file (- for stderr)", metavar="LOG")
+    parser.add_option("-d", "--debug", dest="debug", default=False, action="store_true",
+                  help="Debug logging", metavar="DEBUG")
+    (options, args) = parser.parse_args()
+
+    # setup the logger
+    hdlr = logging.StreamHandler() if options.log == '-' else logging.FileHandler(options.log)
+    hdlr.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(hdlr)
+    logger.setLevel(logging.DEBUG if options.debug else logging.INFO)
+    pentaho_pam.logger.addHandler(hdlr)
+    pentaho_pam.logger.setLevel(logging.WARN)
+
+    if options.workers < 1:
+        logger.error('Workers must be at least 1')
+        sys.exit(1)
+
+    serve(options)
@@ -15,6 +15,120 @@ process query:
 
   python pentaho_saiku_adhoc_run.py --url='http://localhost:8080/pentaho' --user='admin' --passwd='admin' --name=test-adhoc.adhoc --solution=a-solution --path=a-path
 
+process a batch of queries over one HTTP session:
+
+  python pentaho_saiku_adhoc_run.py --url='http://localhost:8080/pentaho' --user='admin' --passwd='admin' --batch=reports.csv
+
+Several output types can be generated from one run of the query with a list eg: --type=pdf,xls,csv
+(this requires --generate), and the file names are written to stdout one per line.
+
+The batch manifest (a file, or - for stdin) has one query per line as CSV (quote the type
+column when it is a list):
+
+  name,solution,path,type,url
+
+Blank lines and lines starting with # are ignored, and empty solution, path, type or url
+columns fall back to the command line values.
+
+Batch queries can be run in parallel with --workers, while --max-per-server caps the
+number of queries in flight against any one Pentaho URL, and --timeout puts a limit on
+the time each query can take eg:
+
+  python pentaho_saiku_adhoc_run.py --url='http://localhost:8080/pentaho' --user='admin' --passwd='admin' --batch=reports.csv --workers=16 --max-per-server=4 --timeout=600
+
+A table of query latencies is logged when the batch completes.
+
+Exports are cached on disk (--cache-dir, default /tmp/pentaho_saiku_cache) keyed on the
+fetched query definition, the --user, the output type and an optional --freshness token, so repeated
+exports of an unchanged report only cost the definition lookup.  Entries expire after
+--cache-ttl seconds and the least recently used are evicted once the cache grows past
+--cache-size MB.  Use --refresh to re-run and replace a cached export, or --no-cache to
+bypass the cache entirely.
+
+Saiku Analytics queries are executed with a small result probe (--preview=probe, fetching
+--preview-rows rows) rather than downloading the entire cell set before the export, and
+the row count it returns is logged and added to batch records.  --preview=full restores
+the full result fetch, and --preview=skip goes straight to the export for servers where
+the export executes the query itself.
+
+Saiku Adhoc report parameters and filters can be set for a run without changing the
+repository file with --param NAME=VALUE (repeat the option for multiple values) eg:
+
+  python pentaho_saiku_adhoc_run.py ... --name=sales.adhoc --param=department=Sales --param=department=Marketing
+
+Saiku Analytics queries take parameters as ${NAME} placeholders in the saved query.
+
+A query (or every query of a batch) can be run once per row of a CSV parameter matrix with
+--matrix.  The header row names the parameters and each following row holds the values for
+one run, with multiple values separated by | eg:
+
+  department,region
+  Sales,North|South
+  Marketing,
+
+The runs are made as a batch with a JSON result record each, and the report definition is
+only fetched once however many rows there are.  --template-ttl keeps fetched definitions
+on disk for that many seconds so later runs can skip the lookup too.
+
+The wall time, bytes downloaded and HTTP status of the lookup, create, execute and export
+phases of every query run are recorded against its rep_uuid.  --timings appends them to a
+file as one JSON line per run (- for stderr), and --prom-textfile writes them as gauges
+for the Prometheus node exporter textfile collector eg:
+
+  python pentaho_saiku_adhoc_run.py ... --timings=/var/log/saiku_runs.json --prom-textfile=/var/lib/node_exporter/saiku.prom
+
+Every call to Pentaho is made with a --connect-timeout and --read-timeout.
+
+Long running reports can be submitted to run in the background with --submit, which writes
+a job id (the rep_uuid) to stdout straight away.  The job is collected later with --fetch,
+which writes the generated file names to stdout when it is done, exits with 75 if it is
+still running (or waits up to --wait seconds for it), and exits with 1 if it failed eg:
+
+  JOB=`python pentaho_saiku_adhoc_run.py ... --name=big.adhoc --type=pdf,xls --submit`
+  python pentaho_saiku_adhoc_run.py ... --fetch=$JOB --wait=1800
+
+Job state is kept in --state-dir.  Submitted jobs retry failed calls --retries times with
+exponential --backoff, and a fetch of a job that failed, or whose process died, resumes it
+from the last completed phase without repeating finished exports.
+
+Generated files are written to --spool-dir (default /tmp) under a temporary name and
+renamed into place once complete.  --compress=gzip compresses them as they are written,
+--compress=zip (--generate only) zips each file once its download has finished, and
+--split-size=MB splits a CSV export into several files of at most that size, each starting
+with the header row eg:
+
+  python pentaho_saiku_adhoc_run.py ... --type=csv --generate --compress=gzip --split-size=10
+
+The generated file names are printed one per line, or all on one line separated by
+--file-separator (the PDI transformation uses --file-separator=| and splits the
+"Result output" field on it, so every file of a split or multi-type run is attached).
+
+A split export writes one file name per line to stdout.
+
+The reports in the Pentaho repository can be crawled into a local SQLite index (--index-file,
+default repository.db in --cache-dir) - only new or changed definitions are fetched again:
+
+  python pentaho_saiku_adhoc_run.py --url=... --user=... --passwd=... --index
+
+--list prints the indexed reports as batch manifest lines.  Once a repository has been
+indexed, queries against it are checked before they are run: an unknown report fails
+without a call to the server, and a name that is unique in the repository is resolved to
+its solution and path.  Use --no-index to skip the check.
+
+To save the start up and connection cost of every report run, the runner can be left
+running as a daemon that takes queries over a unix socket (--socket, default
+/tmp/pentaho_saiku_run.sock or $PENTAHO_SAIKU_SOCKET) and runs them on a warm pool of
+--workers with pooled Pentaho connections eg:
+
+  python pentaho_saiku_adhoc_run.py --serve --workers=8 --max-per-server=4
+
+While a daemon is listening, a normal --generate run (as used by the PDI transformation)
+hands its query to the daemon and writes the generated file names to stdout as usual.
+Use --no-daemon to run the query in process regardless.  Each query result is written to stdout
+as a JSON record eg:
+
+  {"name": "test-adhoc.adhoc", "solution": "a-solution", "path": "", "type": "pdf", "status": "ok", "files": ["/tmp/test-adhoc-20140101-060000.pdf"]}
+
 
 Copyright (C) Piers Harding 2014 and beyond, All rights reserved
 
@@ -38,9 +152,1662 @@ import logging
 from datetime import datetime
 import time
 import itertools
-import requests
 import json
 import uuid
+import csv
+import threading
+import Queue
+import hashlib
+import fcntl
+from xml.sax.saxutils import escape as xml_escape
+import socket
+import SocketServer
+import signal
+import copy
+import collections
+import gzip
+import zipfile
+import tempfile
+import bisect
+import sqlite3
+from xml.etree import ElementTree
+
+
+# requests is imported on first use (see load_requests) so that a client
+# handing its query to the runner daemon starts as fast as possible
+requests = None
+
+def load_requests():
+    global requests
+    if requests is None:
+        import requests as _requests
+        requests = _requests
+
+
+OUTPUT_TYPES = ['csv', 'xls', 'pdf']
+
+
+# a failed Pentaho call (with its HTTP status) or invalid query specification
+class RunError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# make sure that a call was successful
+def check_response(res, action):
+    if not res.status_code == 200:
+        res.close()
+        raise RunError("Call to " + action + " failed: " + str(res.status_code) + ": " + str(res.reason), res.status_code)
+
+
+# connect and read timeouts in seconds for every call - set by --connect-timeout
+# and --read-timeout (0 for no limit)
+HTTP_TIMEOUT = {'connect': 30.0, 'read': 3600.0}
+
+
+# the (connect, read) timeout for a call - cut short by the query deadline
+def remaining(query):
+    connect = HTTP_TIMEOUT['connect'] or None
+    read = HTTP_TIMEOUT['read'] or None
+    if query.get('deadline'):
+        left = query['deadline'] - time.time()
+        if left <= 0:
+            raise RunError("Query timed out")
+        connect = min(connect or left, left)
+        read = min(read or left, left)
+    return (connect, read)
+
+
+# call fn, retrying with exponential backoff on connection errors and server
+# (5xx) errors - anything else, and a retry whose backoff would run past the
+# query deadline, is raised at once
+def with_retries(options, action, fn, deadline=None):
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except (RunError, requests.exceptions.RequestException) as e:
+            if isinstance(e, RunError) and not (e.status and e.status >= 500):
+                raise
+            delay = options.backoff * (2 ** attempt)
+            if attempt >= options.retries or (deadline and time.time() + delay >= deadline):
+                raise
+            attempt += 1
+            logging.warn("%s failed (%s) - retry %d of %d in %.1fs" % (action, str(e), attempt, options.retries, delay))
+            time.sleep(delay)
+
+
+# per Pentaho server limit on the number of queries in flight
+server_slots = {}
+server_slots_lock = threading.Lock()
+
+def server_slot(url, limit):
+    with server_slots_lock:
+        if not url in server_slots:
+            server_slots[url] = threading.BoundedSemaphore(limit)
+        return server_slots[url]
+
+
+# one HTTP session with keep-alive pooling is used for all calls
+def create_session(pool_size=1):
+    load_requests()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# validate a query specification and fill in the defaults
+def normalise_query(query):
+
+    if not query.get('name'):
+        raise RunError("Query name not supplied")
+
+    # set default to adhoc queries
+    if not re.match(r'^.*?\.\w+$', query['name']) :
+        query['name'] = query['name'] + '.adhoc'
+
+    if not re.match(r'^.*?\.(adhoc|saiku)$', query['name']) :
+        raise RunError("Query name (%s) must be the repository file and end in either .adhoc or .saiku" % query['name'])
+
+    # several output types can be exported from one run eg: pdf,xls,csv
+    query['types'] = []
+    for t in str(query.get('type')).split(','):
+        t = t.strip()
+        if not t in OUTPUT_TYPES:
+            raise RunError("Type must be xls, csv or pdf - or a comma separated list of them")
+        if not t in query['types']:
+            query['types'].append(t)
+    query['type'] = ",".join(query['types'])
+
+    if query.get('path') == None:
+        query['path'] = ""
+
+    if query.get('solution') == None:
+        query['solution'] = ""
+
+    return query
+
+
+# read a parameter matrix - a CSV file with a header row of parameter names
+# and then one row of values per run, with multiple values separated by |
+def read_matrix(matrix):
+
+    fh = open(matrix, 'rb')
+    reader = csv.reader(fh)
+    names = None
+    rows = []
+    for row in reader:
+        if not row or not "".join(row).strip() or row[0].strip().startswith('#'):
+            continue
+        if names == None:
+            names = [c.strip() for c in row]
+            continue
+        params = {}
+        for name, value in zip(names, row):
+            if value.strip():
+                params[name] = [v.strip() for v in value.split('|')]
+        rows.append(params)
+    fh.close()
+    return rows
+
+
+# expand each query into one query per row of the parameter matrix
+def expand_matrix(queries, matrix):
+
+    expanded = []
+    for query in queries:
+        for params in matrix:
+            q = dict(query)
+            q['params'] = dict(query.get('params') or {})
+            q['params'].update(params)
+            q['label'] = "_".join("-".join(params[k]) for k in sorted(params))
+            expanded.append(q)
+    return expanded
+
+
+# read the batch manifest - one CSV line of name,solution,path,type,url per query
+def read_manifest(manifest, options):
+
+    if manifest == '-':
+        fh = sys.stdin
+    else:
+        fh = open(manifest, 'rb')
+
+    queries = []
+    for row in csv.reader(fh):
+        if not row or not "".join(row).strip() or row[0].strip().startswith('#'):
+            continue
+        row = [c.strip() for c in row] + [''] * 5
+        queries.append({'name': row[0],
+                        'solution': row[1] or options.solution,
+                        'path': row[2] or options.path,
+                        'type': row[3] or options.output_type,
+                        'url': (row[4] or options.url).rstrip('/'),
+                        'params': options.params})
+
+    if not fh == sys.stdin:
+        fh.close()
+    return queries
+
+
+# writes an export to the spool directory (or stdout), optionally gzip compressed
+# as it is written and, for CSV, split into parts of at most split_size bytes that
+# each start with the header row.  Files are written as .part files and only renamed
+# to their final names once complete, so a reader never sees a partial report.
+# zip compression is applied by close(), once each file has been written in full
+class ReportWriter(object):
+
+    def __init__(self, query, options):
+        self.query = query
+        self.compress = options.compress
+        self.spool_dir = options.spool_dir
+        self.split_size = 0
+        if options.split_size and query['type'] == 'csv':
+            self.split_size = options.split_size * 1024 * 1024
+        self.base = re.sub(r'%..', '', re.sub(r'.*?\/', '', query['name']))
+        if query.get('label'):
+            self.base += '-' + re.sub(r'[^\w.-]+', '_', query['label'])
+        self.base += '-' + time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        self.parts = []
+        self.raw = None
+        self.out = None
+        self.size = 0
+        self.header = None
+        self.pending = b''
+        if options.generate_file:
+            self.next_part()
+        else:
+            self.raw = sys.stdout
+            self.out = sys.stdout
+            if self.compress == 'gzip':
+                self.out = gzip.GzipFile(self.base + '.' + query['type'], 'wb', fileobj=sys.stdout)
+
+    # start writing the next .part file
+    def next_part(self):
+        if self.raw:
+            self.close_part()
+        fd, part = tempfile.mkstemp(prefix='.' + self.base + '-', suffix='.part', dir=self.spool_dir)
+        os.fchmod(fd, 0o644)
+        self.parts.append(part)
+        self.raw = os.fdopen(fd, 'wb')
+        self.out = self.raw
+        if self.compress == 'gzip':
+            self.out = gzip.GzipFile(self.base + '.' + self.query['type'], 'wb', fileobj=self.raw)
+        self.size = 0
+        if self.header:
+            self.out.write(self.header)
+            self.size = len(self.header)
+
+    def close_part(self):
+        if not self.out is self.raw:
+            self.out.close()
+        self.raw.close()
+
+    # the offsets just past each complete CSV record in data - a newline inside
+    # a quoted field does not end a record
+    def record_ends(self, data):
+        ends = []
+        quotes = 0
+        pos = 0
+        while True:
+            nl = data.find(b'\n', pos)
+            if nl < 0:
+                return ends
+            quotes += data.count(b'"', pos, nl)
+            pos = nl + 1
+            if quotes % 2 == 0:
+                ends.append(pos)
+                quotes = 0
+
+    def write(self, chunk):
+        if not self.split_size:
+            self.out.write(chunk)
+            return
+
+        # only whole records are written, so that every part is valid CSV
+        data = self.pending + chunk
+        ends = self.record_ends(data)
+        if not ends:
+            self.pending = data
+            return
+        self.pending = data[ends[-1]:]
+        if self.header is None:
+            self.header = data[:ends[0]]
+
+        start = 0
+        while start < ends[-1]:
+            # the records that still fit in this part
+            i = bisect.bisect_right(ends, start + self.split_size - self.size)
+            cut = ends[i - 1] if i and ends[i - 1] > start else start
+            if cut == start:
+                if self.size > len(self.header):
+                    self.next_part()
+                    continue
+                # a single record bigger than a part goes in a part of its own
+                cut = ends[bisect.bisect_right(ends, start)]
+            self.out.write(data[start:cut])
+            self.size += cut - start
+            start = cut
+
+    # reserve a unique final name for a part
+    def reserve(self, suffix):
+        base = os.path.join(self.spool_dir, self.base) + suffix
+        report_file = base + '.' + self.query['type']
+        extension = {'gzip': '.gz', 'zip': '.zip'}.get(self.compress, '')
+        i = 0
+        while True:
+            try:
+                os.close(os.open(report_file + extension, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                return report_file, report_file + extension
+            except OSError:
+                if not os.path.exists(report_file + extension):
+                    raise
+                i += 1
+                report_file = base + '-' + str(i) + '.' + self.query['type']
+
+    # finish the export, and return the names of the files written
+    def close(self):
+        if self.pending:
+            # a last record with no line ending
+            if self.split_size and self.header and self.size > len(self.header) and \
+               self.size + len(self.pending) > self.split_size:
+                self.next_part()
+            self.out.write(self.pending)
+            self.pending = b''
+        if not self.parts:
+            if not self.out is self.raw:
+                self.out.close()
+            self.raw.flush()
+            return []
+        self.close_part()
+
+        files = []
+        for n, part in enumerate(self.parts):
+            suffix = '-part' + str(n + 1) if len(self.parts) > 1 else ''
+            report_file, final = self.reserve(suffix)
+            if self.compress == 'zip':
+                archive = part + '.zip'
+                zf = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, True)
+                try:
+                    zf.write(part, os.path.basename(report_file))
+                finally:
+                    zf.close()
+                os.chmod(archive, 0o644)
+                os.unlink(part)
+                self.parts[n] = part = archive
+            os.rename(part, final)
+            files.append(final)
+        self.parts = []
+        return files
+
+    # throw away a failed export - nothing is left behind in the spool directory
+    def abort(self):
+        if self.parts:
+            try:
+                self.close_part()
+            except (IOError, OSError):
+                pass
+            for part in self.parts:
+                for name in (part, part + '.zip'):
+                    if os.path.exists(name):
+                        os.unlink(name)
+            self.parts = []
+
+
+# cache of the report definitions fetched from the repository so that each is
+# only looked up once per run however many times it is expanded - optionally
+# kept on disk for ttl seconds along with the repository last modified time,
+# and in memory for no more than max_age seconds
+class TemplateCache(object):
+
+    def __init__(self, directory=None, ttl=0, max_age=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        self.index = None
+        self.templates = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1("\0".join(key).encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, key):
+        if not self.directory:
+            return None
+        try:
+            fh = open(self.path(key), 'rb')
+            entry = json.load(fh)
+            fh.close()
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry.get('fetched', 0) > self.ttl:
+            return None
+        return entry
+
+    def save(self, key, entry):
+        if not self.directory:
+            return
+        path = self.path(key)
+        part = path + '.' + uuid.uuid4().hex + '.part'
+        fh = open(part, 'wb')
+        json.dump(entry, fh)
+        fh.close()
+        os.rename(part, path)
+        self.prune()
+
+    # expired definitions are never read again - remove them (and .part files left
+    # by a crash) whenever a definition is saved
+    def prune(self):
+        now = time.time()
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            try:
+                if now - os.stat(path).st_mtime > (max(self.ttl, 3600) if f.endswith('.part') else self.ttl):
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    # a definition is out of date when the repository index shows that the report
+    # has been changed since it was fetched
+    def changed(self, key, entry):
+        if not self.index:
+            return False
+        modified = self.index.modified(*key[:4])
+        return bool(modified) and modified > entry['fetched'] * 1000
+
+    # the definition of the query's report - fetched with lookup when not cached.
+    # definitions are only shared by runs as the same Pentaho user, who the
+    # repository has already allowed to read the report
+    def get(self, session, query, options, lookup):
+        key = (query['url'], query['solution'], query['path'], query['name'], options.user or '')
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # a long running process (the daemon) must not hold on to old definitions
+            if key in self.templates and self.max_age != None and \
+               time.time() - self.templates[key]['fetched'] > self.max_age:
+                del self.templates[key]
+            if key in self.templates and self.changed(key, self.templates[key]):
+                del self.templates[key]
+            if not key in self.templates:
+                entry = None if options.refresh else self.load(key)
+                if entry and self.changed(key, entry):
+                    entry = None
+                if entry:
+                    logging.debug("using cached definition for: " + query['name'])
+                else:
+                    definition = lookup(session, query, options)
+                    entry = {'definition': definition.decode('utf-8'),
+                             'last_modified': definition_modified(definition),
+                             'fetched': time.time()}
+                    self.save(key, entry)
+                self.templates[key] = entry
+            return self.templates[key]['definition']
+
+
+# the repository last modified time recorded in a definition, if any
+def definition_modified(definition):
+    try:
+        return json.loads(definition).get('lastModified')
+    except (ValueError, AttributeError):
+        return None
+
+
+# on-disk cache of query exports keyed on the query definition, Pentaho user,
+# output type and data freshness token - expired by age and evicted least recently used
+class ResultCache(object):
+
+    # the names of entries and their .part files - the cache directory also holds
+    # the repository index and the templates directory, which are not evicted
+    ENTRY_NAME = re.compile(r'^[0-9a-f]{40}\.\w+(\.[0-9a-f]{32}\.part)?$')
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    # exports are only shared by runs as the same Pentaho user - another user's
+    # roles and data security may give a different export of the same definition
+    def key(self, query, definition, freshness, user):
+        h = hashlib.sha1()
+        params = json.dumps(query.get('params') or {}, sort_keys=True)
+        for part in (query['url'], user or '', query['type'], freshness or '', params, definition):
+            if not isinstance(part, bytes):
+                part = part.encode('utf-8')
+            h.update(part + b'\0')
+        return h.hexdigest()
+
+    def path(self, key, output_type):
+        return os.path.join(self.directory, key + '.' + output_type)
+
+    # the path of a live cache entry, or None
+    def get(self, key, output_type):
+        path = self.path(key, output_type)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        now = time.time()
+        if now - st.st_mtime > self.ttl:
+            self.remove(path)
+            return None
+        # mtime is the age of the entry, atime when it was last used
+        try:
+            os.utime(path, (now, st.st_mtime))
+        except OSError as e:
+            logging.warn("cannot mark cache entry used: " + str(e))
+        return path
+
+    # new entries are written to a .part file and renamed into place when complete
+    def open_entry(self, key, output_type):
+        part = self.path(key, output_type) + '.' + uuid.uuid4().hex + '.part'
+        return part, open(part, 'wb')
+
+    # the cache is optional - a write that fails is dropped and the export goes on
+    def discard(self, part, fh, error):
+        logging.warn("not caching export - cannot write %s: %s" % (part, str(error)))
+        try:
+            fh.close()
+        except EnvironmentError:
+            pass
+        self.remove(part)
+
+    def commit(self, part, key, output_type):
+        try:
+            os.rename(part, self.path(key, output_type))
+        except OSError as e:
+            logging.warn("not caching export - cannot store %s: %s" % (part, str(e)))
+            self.remove(part)
+            return
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        try:
+            self.evict_entries()
+        except OSError as e:
+            logging.warn("cannot evict from export cache: " + str(e))
+
+    def evict_entries(self):
+        with self.lock:
+            now = time.time()
+            entries = []
+            for f in os.listdir(self.directory):
+                if not self.ENTRY_NAME.match(f):
+                    continue
+                path = os.path.join(self.directory, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if f.endswith('.part'):
+                    # left behind by a crashed or failed download
+                    if now - st.st_mtime > max(self.ttl, 3600):
+                        self.remove(path)
+                elif now - st.st_mtime > self.ttl:
+                    self.remove(path)
+                else:
+                    entries.append((st.st_atime, st.st_size, path))
+
+            total = sum(e[1] for e in entries)
+            for atime, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logging.debug("evicting cache entry: " + path)
+                self.remove(path)
+                total -= size
+
+
+# look for a cached export of the query definition - the cache key is kept on
+# the query so that a fresh export can be stored against it
+def check_cache(definition, query, options):
+
+    if not options.cache:
+        return None
+    query['cache_key'] = options.cache.key(query, definition, options.freshness, options.user)
+    if options.refresh:
+        return None
+    cached = options.cache.get(query['cache_key'], query['type'])
+    if cached:
+        logging.info("using cached export for: " + query['name'] + " (" + query['type'] + ")")
+        query['cached'] = True
+    return cached
+
+
+# write the report chunks to the report file(s) (or stdout), and the cache if required.
+# returns the names of the files written
+def write_report(chunks, query, options, cache_key=None):
+
+    writer = ReportWriter(query, options)
+
+    part = cache_out = None
+    if cache_key:
+        try:
+            part, cache_out = options.cache.open_entry(cache_key, query['type'])
+        except EnvironmentError as e:
+            logging.warn("not caching export - cannot open a cache entry: " + str(e))
+
+    total = 0
+    start = time.time()
+    try:
+        for chunk in chunks:
+            if chunk:
+                writer.write(chunk)
+                if cache_out:
+                    try:
+                        cache_out.write(chunk)
+                    except EnvironmentError as e:
+                        options.cache.discard(part, cache_out, e)
+                        cache_out = None
+                total += len(chunk)
+            remaining(query)
+        report_files = writer.close()
+    except:
+        if cache_out:
+            cache_out.close()
+            options.cache.remove(part)
+        # never leave a truncated report behind
+        writer.abort()
+        raise
+    elapsed = time.time() - start
+
+    if cache_out:
+        try:
+            cache_out.close()
+        except EnvironmentError as e:
+            options.cache.discard(part, cache_out, e)
+            cache_out = None
+        if cache_out:
+            options.cache.commit(part, cache_key, query['type'])
+
+    query['bytes'] = total
+    rate = total / elapsed if elapsed > 0 else float(total)
+    logging.info("export complete: %d bytes in %.2fs (%.0f bytes/sec)" % (total, elapsed, rate))
+
+    return report_files
+
+
+# stream an export response to the report file (or stdout) chunk by chunk
+# so that large exports never have to be held in memory
+def stream_report(res, query, options):
+
+    try:
+        return write_report(res.iter_content(chunk_size=options.chunk_size), query, options, query.get('cache_key'))
+    finally:
+        res.close()
+
+
+# copy a cached export to the report file (or stdout)
+def copy_report(cached, query, options):
+
+    start = time.time()
+    fh = open(cached, 'rb')
+    try:
+        report_files = write_report(iter(lambda: fh.read(options.chunk_size), b''), query, options)
+    finally:
+        fh.close()
+    record_phase(query, 'export', start, status='cached', size=query['bytes'])
+    return report_files
+
+
+# look up the Saiku Adhoc report definition
+def lookup_adhoc(session, query, options):
+
+    definition_url = query['url'] + "/content/saiku-adhoc/rest/repository/query/" + \
+        query['name'] + "?name=" + query['name'] + \
+        "&solution=" + str(query['solution']) + "&path=" + str(query['path']) + \
+        "&action=" + query['name'] + \
+        "&userid=" + options.user + "&password=" + options.passwd
+
+    headers = {'content-type': 'application/json',
+               'accept': 'application/json, text/javascript, */*; q=0.01'}
+    start = time.time()
+    res = session.get(definition_url, headers=headers, timeout=remaining(query))
+    record_phase(query, 'lookup', start, res)
+    check_response(res, "lookup report")
+    logging.debug("content: " + res.text)
+    # payload = json.loads(res.text)
+    return res.content
+
+
+# repository fields of an adhoc definition that must not be sent when
+# creating a report instance
+ADHOC_STRIPPED_FIELDS = ['name', 'newname', 'lastModified', 'solution', 'action', 'path', 'overwrite']
+
+
+# remove the repository fields from the adhoc definition
+def strip_adhoc_fields(model, query):
+    for field in ADHOC_STRIPPED_FIELDS:
+        model.pop(field, None)
+    return model
+
+
+# set the values of the adhoc report parameters and filters named in the
+# query params eg: --param=department=Sales
+def override_adhoc_params(model, query):
+
+    params = query.get('params') or {}
+    found = set()
+    for section in ('parameters', 'filters'):
+        for item in model.get(section) or []:
+            if not isinstance(item, dict):
+                continue
+            for key in ('name', 'id', 'column'):
+                if item.get(key) in params:
+                    item['parameterValues'] = params[item[key]]
+                    found.add(item[key])
+                    break
+
+    for name in set(params) - found:
+        logging.warn("parameter " + name + " not found in report: " + query['name'])
+    return model
+
+
+# transformations applied in order to the parsed adhoc definition before the
+# report instance is created - each takes (model, query) and returns the model
+ADHOC_TRANSFORMS = [strip_adhoc_fields, override_adhoc_params]
+
+
+# parse, transform and serialise an adhoc definition - the keys keep the order
+# of the saved definition, so the same definition always gives the same payload
+def rewrite_adhoc(definition, query):
+
+    try:
+        model = json.loads(definition, object_pairs_hook=collections.OrderedDict)
+    except ValueError as e:
+        raise RunError("Report definition for " + query['name'] + " is not valid JSON: " + str(e))
+    for transform in ADHOC_TRANSFORMS:
+        model = transform(model, query)
+    return json.dumps(model, separators=(',', ':'))
+
+
+# create and run a Saiku Adhoc report instance
+def create_adhoc(session, query, options, rep_uuid, definition):
+
+    # create the report instance
+    payload = rewrite_adhoc(definition, query)
+    logging.debug("json: " + str(payload))
+
+    headers = {'content-type': 'application/json',
+               'accept': 'application/json, text/javascript, */*; q=0.01'}
+    create_url = query['url'] + "/content/saiku-adhoc/rest/query/" + rep_uuid + \
+        "?userid=" + options.user + "&password=" + options.passwd
+    start = time.time()
+    res = session.post(create_url, headers=headers, data=payload, timeout=remaining(query))
+    record_phase(query, 'create', start, res)
+    check_response(res, "create report instance")
+    # logging.debug("content: " + res.text)
+
+    # run the report
+    report_url = query['url'] + "/content/saiku-adhoc/rest/query/" + rep_uuid + \
+        "/report/1?_=" + str(int(time.time())) + \
+        "&userid=" + options.user + "&password=" + options.passwd
+
+    headers = {}
+    start = time.time()
+    res = session.get(report_url, headers=headers, timeout=remaining(query))
+    record_phase(query, 'execute', start, res)
+    check_response(res, "run report")
+    # logging.debug("content: " + res.text)
+
+
+# export URL for a Saiku Adhoc report instance
+def adhoc_export_url(query, options, rep_uuid, output_type):
+    return query['url'] + "/content/saiku-adhoc/rest/export/" + rep_uuid + \
+        "/" + output_type + \
+        "?userid=" + options.user + "&password=" + options.passwd
+
+
+# look up the Saiku Analytics query definition
+def lookup_saiku(session, query, options):
+
+    filename = ""
+    if len(str(query['solution'])) > 0:
+        filename = query['solution'] + '%2F'
+    filename += query['name']
+    definition_url = query['url'] + "/content/saiku/admin/pentahorepository2/resource?file=" + filename + \
+        "&userid=" + options.user + "&password=" + options.passwd
+
+    headers = {'content-type': 'application/x-www-form-urlencoded',
+               'accept': 'text/plain, */*; q=0.01'}
+    start = time.time()
+    res = session.get(definition_url, headers=headers, timeout=remaining(query))
+    record_phase(query, 'lookup', start, res)
+    check_response(res, "lookup report")
+    logging.debug("content: " + res.text)
+    return res.content
+
+
+# replace ${NAME} placeholders in a Saiku Analytics query with the query params
+def substitute_saiku_params(definition, query):
+
+    params = query.get('params') or {}
+    if not params:
+        return definition
+
+    def value(m):
+        if m.group(1) in params:
+            return xml_escape(",".join(params[m.group(1)]))
+        return m.group(0)
+
+    return re.sub(r'\$\{([\w.-]+)\}', value, definition)
+
+
+# create and run a Saiku Analytics query instance
+def create_saiku(session, query, options, rep_uuid, definition):
+
+    # create the report instance
+    payload = {'xml': substitute_saiku_params(definition, query), 'formatter': 'flattened', 'type': 'QM'}
+    logging.debug("parameters: " + str(payload))
+
+    headers = {'content-type': 'application/x-www-form-urlencoded',
+               'accept': 'application/json, text/javascript, */*; q=0.01'}
+    create_url = query['url'] + "/content/saiku/admin/query/" + rep_uuid + \
+        "?userid=" + options.user + "&password=" + options.passwd
+    start = time.time()
+    res = session.post(create_url, headers=headers, data=payload, timeout=remaining(query))
+    record_phase(query, 'create', start, res)
+    check_response(res, "create report instance")
+    logging.debug("content: " + res.text)
+
+    # execute the query - the export renders the result itself, so by default
+    # only the first rows are fetched (limit=0 fetches the entire cell set)
+    if options.preview == 'skip':
+        return
+    limit = 0 if options.preview == 'full' else options.preview_rows
+    report_url = query['url'] + "/content/saiku/admin/query/" + rep_uuid + \
+        "/result/flattened?limit=" + str(limit) + "&_=" + str(int(time.time())) + \
+        "&userid=" + options.user + "&password=" + options.passwd
+
+    headers = {}
+    start = time.time()
+    res = session.get(report_url, headers=headers, timeout=remaining(query))
+    record_phase(query, 'execute', start, res)
+    check_response(res, "run report")
+    if options.preview == 'full':
+        logging.debug("content: " + res.text)
+        return
+
+    # the row count of the result is kept as a metric - height is only the
+    # size of the probe, so without totalRows the count is left unset
+    try:
+        result = res.json()
+    except ValueError:
+        result = {}
+    if not isinstance(result, dict) or result.get('totalRows') is None:
+        logging.warn("could not read the row count for: " + query['name'])
+        return
+    query['rows'] = result['totalRows']
+    logging.info("query " + query['name'] + " returned " + str(query['rows']) + " rows")
+
+
+# export URL for a Saiku Analytics query instance
+def saiku_export_url(query, options, rep_uuid, output_type):
+    return query['url'] + "/content/saiku/admin/query/" + rep_uuid + \
+        "/export/" + output_type + \
+        "/flattened?userid=" + options.user + "&password=" + options.passwd
+
+
+# lookup, create and export functions for each repository file type
+REPORT_TYPES = {
+    'adhoc': (lookup_adhoc, create_adhoc, adhoc_export_url),
+    'saiku': (lookup_saiku, create_saiku, saiku_export_url),
+}
+
+
+# the reports in the Pentaho solution repository of url, as a list of
+# (solution, path, name, last modified) - the first directory level is the solution
+def crawl_repository(session, url, options):
+
+    repository_url = url + "/SolutionRepositoryService?component=getSolutionRepositoryDoc" + \
+        "&userid=" + options.user + "&password=" + options.passwd
+    res = session.get(repository_url, headers={'accept': 'text/xml'}, timeout=remaining({}))
+    check_response(res, "read repository")
+    try:
+        root = ElementTree.fromstring(res.content)
+    except ElementTree.ParseError as e:
+        raise RunError("read repository failed: " + str(e))
+
+    reports = []
+
+    def walk(element, parents):
+        for f in element.findall('file'):
+            name = f.get('name')
+            if f.get('isDirectory') == 'true':
+                walk(f, parents + [name])
+            elif parents and name.split('.')[-1] in REPORT_TYPES:
+                try:
+                    modified = int(f.get('lastModifiedDate'))
+                except (TypeError, ValueError):
+                    modified = None
+                reports.append((parents[0], '/'.join(parents[1:]), name, modified))
+
+    walk(root, [])
+    return reports
+
+
+# local index of the reports in the Pentaho solution repositories, kept in SQLite so
+# that queries can be checked (and resolved) without a round trip to the server.
+# Lookups are served from an in memory copy that is reloaded when the file changes
+class RepositoryIndex(object):
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS reports (
+                    url TEXT NOT NULL,
+                    solution TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    last_modified INTEGER,
+                    hash TEXT,
+                    indexed REAL,
+                    PRIMARY KEY (url, solution, path, name))"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reports = {}
+        self.names = {}
+        self.urls = set()
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        db = sqlite3.connect(self.filename)
+        db.execute(self.SCHEMA)
+        return db
+
+    # crawl the repository of url into the index - only the definitions of new or
+    # changed reports are fetched and hashed.  Returns the (indexed, fetched, removed) counts
+    def refresh(self, session, url, options):
+
+        reports = crawl_repository(session, url, options)
+        db = self.connect()
+        try:
+            known = dict(((r[0], r[1], r[2]), r[3:]) for r in
+                         db.execute("SELECT solution, path, name, last_modified, hash FROM reports WHERE url = ?", (url,)))
+            fetched = 0
+            for solution, path, name, modified in reports:
+                key = (solution, path, name)
+                if key in known and known[key][1] and modified and known[key][0] == modified:
+                    continue
+                query = normalise_query({'name': name, 'solution': solution, 'path': path, 'url': url, 'type': 'pdf'})
+                query['phases'] = []
+                digest = None
+                try:
+                    definition = REPORT_TYPES[query['name'].split('.')[-1]][0](session, query, options)
+                    digest = hashlib.sha1(definition).hexdigest()
+                    fetched += 1
+                except (RunError, requests.exceptions.RequestException) as e:
+                    # indexed without a hash, so it is fetched again next time
+                    logging.warn("could not fetch definition of %s/%s: %s" % (solution, name, str(e)))
+                db.execute("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (url, solution, path, name, name.split('.')[-1], modified, digest, time.time()))
+
+            seen = set((r[0], r[1], r[2]) for r in reports)
+            removed = [key for key in known if not key in seen]
+            for key in removed:
+                db.execute("DELETE FROM reports WHERE url = ? AND solution = ? AND path = ? AND name = ?", (url,) + key)
+            db.commit()
+        finally:
+            db.close()
+        return len(reports), fetched, len(removed)
+
+    # every report in the index, optionally only those of url
+    def entries(self, url=None):
+        db = self.connect()
+        try:
+            sql = "SELECT url, solution, path, name, type, last_modified, hash FROM reports"
+            if url:
+                return db.execute(sql + " WHERE url = ? ORDER BY solution, path, name", (url,)).fetchall()
+            return db.execute(sql + " ORDER BY url, solution, path, name").fetchall()
+        finally:
+            db.close()
+
+    # (re)load the in memory copy if the index file has changed - false if there is no index
+    def load(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            return False
+        with self.lock:
+            if not mtime == self.loaded:
+                reports = {}
+                names = {}
+                for url, solution, path, name, type, modified, digest in self.entries():
+                    reports[(url, solution, path, name)] = {'last_modified': modified, 'hash': digest}
+                    names.setdefault((url, name), []).append((solution, path))
+                self.reports = reports
+                self.names = names
+                self.urls = set(k[0] for k in reports)
+                self.loaded = mtime
+        return True
+
+    # the repository last modified time (ms) of a report, if it is indexed
+    def modified(self, url, solution, path, name):
+        if not self.load():
+            return None
+        return self.reports.get((url, solution, path, name), {}).get('last_modified')
+
+    # check that a query's report exists - when the solution and path do not match
+    # but the name is unique in the repository, the query is resolved to it.
+    # Repositories that have never been indexed are not checked
+    def resolve(self, query):
+        if not self.load():
+            return
+        key = (query['url'], str(query['solution']), str(query['path']), query['name'])
+        if key in self.reports or not query['url'] in self.urls:
+            return
+        found = self.names.get((query['url'], query['name']), [])
+        if len(found) == 1:
+            logging.info("resolved %s to solution: %s path: %s" % (query['name'], found[0][0], found[0][1]))
+            query['solution'], query['path'] = found[0]
+        elif found:
+            raise RunError("report %s is in several solutions: %s (give --solution and --path)" %
+                           (query['name'], ', '.join('/'.join(f).rstrip('/') for f in found)))
+        else:
+            raise RunError("report %s not found in the repository index (use --index to refresh it)" % query['name'])
+
+
+# record the wall time, bytes transferred and HTTP status of a phase of a query run
+def record_phase(query, phase, start, res=None, status=None, size=None):
+    if res is not None:
+        status = res.status_code
+        size = len(res.content)
+    query['phases'].append({'phase': phase, 'type': query['type'], 'seconds': round(time.time() - start, 4),
+                            'bytes': size, 'status': status})
+
+
+# collects the phase timings of each query run and writes them out as
+# JSON lines and/or a Prometheus node exporter textfile
+class PhaseTimings(object):
+
+    def __init__(self, json_file=None, textfile=None):
+        self.json_file = json_file
+        self.textfile = textfile
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def finish(self, query, error=None):
+        run = {'rep_uuid': query['rep_uuid'],
+               'name': query['name'],
+               'solution': query['solution'],
+               'path': query['path'],
+               'type': query['type'],
+               'params': query.get('params') or {},
+               'status': 'error' if error else 'ok',
+               'started': round(query['started'], 3),
+               'seconds': round(time.time() - query['started'], 4),
+               'bytes': sum(p['bytes'] or 0 for p in query['phases']),
+               'phases': query['phases']}
+        if error:
+            run['error'] = str(error)
+        with self.lock:
+            # only the last run of each report (and params) is kept for the textfile
+            self.runs[(run['solution'], run['path'], run['name'], json.dumps(run['params'], sort_keys=True))] = run
+            if self.json_file:
+                out = sys.stderr if self.json_file == '-' else open(self.json_file, 'a')
+                out.write(json.dumps(run) + "\n")
+                if out == sys.stderr:
+                    out.flush()
+                else:
+                    out.close()
+
+    # the textfile is replaced atomically so the collector never sees half of it
+    def write_textfile(self):
+        if not self.textfile:
+            return
+        with self.lock:
+            runs = sorted(self.runs.values(), key=lambda r: r['started'])
+
+        def labels(run, **extra):
+            report = run['solution'] + '/' + (run['path'] + '/' if run['path'] else '') + run['name']
+            params = ",".join(k + '=' + "|".join(run['params'][k]) for k in sorted(run['params']))
+            pairs = [('report', report), ('params', params)] + sorted(extra.items())
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + "}"
+
+        lines = ["# HELP saiku_report_seconds Wall time of the last run of a Saiku report",
+                 "# TYPE saiku_report_seconds gauge"]
+        lines += ["saiku_report_seconds" + labels(r) + " " + str(r['seconds']) for r in runs]
+        lines += ["# HELP saiku_report_success Whether the last run of a Saiku report succeeded",
+                  "# TYPE saiku_report_success gauge"]
+        lines += ["saiku_report_success" + labels(r) + " " + ('1' if r['status'] == 'ok' else '0') for r in runs]
+        lines += ["# HELP saiku_report_last_run_timestamp_seconds Start time of the last run of a Saiku report",
+                  "# TYPE saiku_report_last_run_timestamp_seconds gauge"]
+        lines += ["saiku_report_last_run_timestamp_seconds" + labels(r) + " " + str(r['started']) for r in runs]
+        lines += ["# HELP saiku_report_phase_seconds Wall time of each phase of a Saiku report run",
+                  "# TYPE saiku_report_phase_seconds gauge"]
+        lines += ["saiku_report_phase_seconds" + labels(r, phase=p['phase'], type=p['type']) + " " + str(p['seconds'])
+                  for r in runs for p in r['phases']]
+        lines += ["# HELP saiku_report_phase_bytes Bytes downloaded in each phase of a Saiku report run",
+                  "# TYPE saiku_report_phase_bytes gauge"]
+        lines += ["saiku_report_phase_bytes" + labels(r, phase=p['phase'], type=p['type']) + " " + str(p['bytes'] or 0)
+                  for r in runs for p in r['phases']]
+        lines += ["# HELP saiku_report_phase_status HTTP status of each phase of a Saiku report run (0 when served from cache)",
+                  "# TYPE saiku_report_phase_status gauge"]
+        lines += ["saiku_report_phase_status" + labels(r, phase=p['phase'], type=p['type']) + " " +
+                  str(p['status'] if isinstance(p['status'], int) else 0) for r in runs for p in r['phases']]
+
+        part = self.textfile + '.' + uuid.uuid4().hex + '.part'
+        fh = open(part, 'w')
+        fh.write("\n".join(lines) + "\n")
+        fh.close()
+        os.rename(part, self.textfile)
+
+
+# download one export of a report instance
+def export_report(session, export, options, url):
+
+    headers = {}
+    start = time.time()
+    res = session.get(url, headers=headers, stream=True, timeout=remaining(export))
+    if not res.status_code == 200:
+        record_phase(export, 'export', start, res)
+    check_response(res, "run report")
+    report_files = stream_report(res, export, options)
+    record_phase(export, 'export', start, status=res.status_code, size=export['bytes'])
+    return report_files
+
+
+# download the exports of a report instance - in parallel when there are
+# several, but within the server's --max-per-server slots.  The caller holds
+# one slot for the query, so the first download runs in that, and further
+# ones only alongside it while the server has slots to spare
+def run_exports(session, exports, options, urls):
+
+    if len(exports) == 1:
+        return [export_report(session, exports[0], options, urls[0])]
+
+    files = [None] * len(exports)
+    errors = []
+    work = Queue.Queue()
+    for i in range(len(exports)):
+        work.put(i)
+    slot = server_slot(exports[0]['url'], options.max_per_server)
+
+    def download():
+        while True:
+            try:
+                i = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                files[i] = export_report(session, exports[i], options, urls[i])
+            except Exception as e:
+                errors.append(e)
+
+    def spare():
+        try:
+            download()
+        finally:
+            slot.release()
+
+    threads = []
+    for i in range(len(exports) - 1):
+        if not slot.acquire(False):
+            break
+        threads.append(threading.Thread(target=spare))
+    for t in threads:
+        t.start()
+    download()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return files
+
+
+# run a single query - the definition is looked up once and the query instance
+# is created and run once, however many output types are requested.
+# returns the generated file names (if any) in output type order
+def run_query(session, query, options):
+
+    rep_uuid = str(uuid.uuid1()).upper()
+    logging.debug("running query: " + repr(query) + " as: " + rep_uuid)
+    lookup, create, export_url = REPORT_TYPES[query['name'].split('.')[-1]]
+
+    query['rep_uuid'] = rep_uuid
+    query['phases'] = []
+    query['started'] = time.time()
+    try:
+        files = run_phases(session, query, options, rep_uuid, lookup, create, export_url)
+    except Exception as e:
+        options.timings.finish(query, e)
+        raise
+    options.timings.finish(query)
+    return files
+
+
+# the lookup, create/execute and export phases of a query run
+def run_phases(session, query, options, rep_uuid, lookup, create, export_url):
+
+    definition = options.templates.get(session, query, options, lookup)
+
+    # each output type is exported separately, and may already be cached
+    exports = [dict(query, type=t) for t in query['types']]
+    files = [None] * len(exports)
+    pending = []
+    for i, export in enumerate(exports):
+        cached = check_cache(definition, export, options)
+        if cached:
+            files[i] = copy_report(cached, export, options)
+        else:
+            pending.append(i)
+    query['cached'] = not pending
+
+    if pending:
+        create(session, query, options, rep_uuid, definition)
+        results = run_exports(session, [exports[i] for i in pending], options,
+                              [export_url(query, options, rep_uuid, exports[i]['type']) for i in pending])
+        for i, report_files in zip(pending, results):
+            files[i] = report_files
+
+    # a split export has several files
+    return [f for report_files in files for f in report_files]
+
+
+# run one batch query and build its result record
+def run_record(session, query, options):
+
+    record = dict((k, query.get(k)) for k in ('name', 'solution', 'path', 'type', 'params'))
+    queued = time.time()
+    start = queued
+    try:
+        normalise_query(query)
+        if options.index:
+            options.index.resolve(query)
+        record.update((k, query[k]) for k in record.keys())
+        with server_slot(query['url'], options.max_per_server):
+            start = time.time()
+            if options.timeout:
+                query['deadline'] = start + options.timeout
+            record['files'] = run_query(session, query, options)
+        record['status'] = 'ok'
+        record['cached'] = query.get('cached', False)
+        if 'rows' in query:
+            record['rows'] = query['rows']
+    except (RunError, requests.exceptions.RequestException, IOError, OSError) as e:
+        logging.error("query %s failed: %s" % (query.get('name'), str(e)))
+        record['status'] = 'error'
+        record['error'] = str(e)
+    except Exception as e:
+        # anything else is a bug, but it must fail this query - not end the worker
+        # and silently drop the rest of the batch
+        logging.exception("query %s failed" % query.get('name'))
+        record['status'] = 'error'
+        record['error'] = "%s: %s" % (e.__class__.__name__, str(e))
+    record['queued'] = round(start - queued, 3)
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+
+# log a table of the batch query latencies, slowest first
+def log_summary(records, elapsed):
+
+    logging.info("%-50s %-4s %-6s %9s %9s" % ('query', 'type', 'status', 'queued', 'seconds'))
+    for r in sorted(records, key=lambda r: r['seconds'], reverse=True):
+        name = (r['solution'] or '') + '/' + (r['path'] + '/' if r['path'] else '') + str(r['name'])
+        logging.info("%-50s %-4s %-6s %9.3f %9.3f" % (name[-50:], r['type'], r['status'], r['queued'], r['seconds']))
+
+    times = sorted(r['seconds'] for r in records)
+    if times:
+        logging.info("%d queries in %.2fs wall time - min: %.3fs median: %.3fs max: %.3fs" %
+                     (len(times), elapsed, times[0], times[len(times) // 2], times[-1]))
+
+
+# run all the queries in a batch manifest over the one session with a pool
+# of worker threads, writing a JSON result record for each query to stdout
+def run_batch(session, queries, options):
+
+    work = Queue.Queue()
+    for query in queries:
+        work.put(query)
+
+    records = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                query = work.get_nowait()
+            except Queue.Empty:
+                return
+            record = run_record(session, query, options)
+            with lock:
+                records.append(record)
+                sys.stdout.write(json.dumps(record) + "\n")
+                sys.stdout.flush()
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(options.workers, len(queries))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # join with a timeout so that the main thread still sees KeyboardInterrupt
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+
+    log_summary(records, time.time() - start)
+    # queries without a record never finished, so they count as failed too
+    failed = len(queries) - len([r for r in records if r['status'] == 'ok'])
+    logging.info("batch complete: %d queries, %d failed" % (len(queries), failed))
+    return failed
+
+
+# state of asynchronous jobs - one JSON file per job, plus a lock file that is
+# held for as long as a process is running the job and a log of the job run
+class JobStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, job_id, ext):
+        if not re.match(r'^[\w-]+$', job_id):
+            raise RunError("Invalid job id: " + job_id)
+        return os.path.join(self.directory, job_id + '.' + ext)
+
+    def load(self, job_id):
+        try:
+            fh = open(self.path(job_id, 'json'), 'rb')
+            job = json.load(fh)
+            fh.close()
+        except (IOError, ValueError) as e:
+            raise RunError("Job " + job_id + " not found: " + str(e))
+        return job
+
+    def save(self, job):
+        job['updated'] = time.time()
+        path = self.path(job['id'], 'json')
+        part = path + '.' + uuid.uuid4().hex + '.part'
+        fh = open(part, 'w')
+        json.dump(job, fh)
+        fh.close()
+        os.rename(part, path)
+
+    # an exclusive lock on the job, or None when another process holds it
+    def lock(self, job_id):
+        fd = os.open(self.path(job_id, 'lock'), os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return None
+        return fd
+
+
+# run (or resume) a job - phases completed by an earlier attempt are skipped, so a
+# job can be run again after a crash or failure without redoing finished exports
+def run_job(session, job, store, options):
+
+    query = normalise_query(dict(job['query']))
+    lookup, create, export_url = REPORT_TYPES[query['name'].split('.')[-1]]
+    query['rep_uuid'] = job['rep_uuid']
+    query['phases'] = []
+    query['started'] = time.time()
+    if options.timeout:
+        query['deadline'] = query['started'] + options.timeout
+
+    job['status'] = 'running'
+    job['pid'] = os.getpid()
+    job['attempts'] += 1
+    job.pop('error', None)
+    store.save(job)
+
+    try:
+        definition = with_retries(options, "lookup report",
+                                  lambda: options.templates.get(session, query, options, lookup),
+                                  query.get('deadline'))
+        pending = []
+        for export in [dict(query, type=t) for t in query['types'] if not t in job['files']]:
+            cached = check_cache(definition, export, options)
+            if cached:
+                job['files'][export['type']] = copy_report(cached, export, options)
+                store.save(job)
+            else:
+                pending.append(export)
+
+        if pending and not job['phase'] == 'export':
+            with_retries(options, "run report",
+                         lambda: create(session, query, options, job['rep_uuid'], definition),
+                         query.get('deadline'))
+            job['phase'] = 'export'
+            store.save(job)
+
+        for export in pending:
+            url = export_url(query, options, job['rep_uuid'], export['type'])
+            try:
+                job['files'][export['type']] = with_retries(options, "export report",
+                                                            lambda: export_report(session, export, options, url),
+                                                            query.get('deadline'))
+            except:
+                # the report instance may have gone from the server - run it again on resume
+                job['phase'] = 'run'
+                raise
+            store.save(job)
+
+    except (RunError, requests.exceptions.RequestException, IOError, OSError) as e:
+        logging.error("job %s failed: %s" % (job['id'], str(e)))
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        store.save(job)
+        options.timings.finish(query, e)
+        return job
+
+    job['status'] = 'done'
+    store.save(job)
+    options.timings.finish(query)
+    return job
+
+
+# submit a query as a job run by a detached background process, and return the job id
+def submit_job(query, store, options):
+
+    rep_uuid = str(uuid.uuid1()).upper()
+    job = {'id': rep_uuid,
+           'rep_uuid': rep_uuid,
+           'query': dict((k, query[k]) for k in ('name', 'solution', 'path', 'type', 'url', 'params')),
+           'status': 'submitted',
+           'phase': 'run',
+           'files': {},
+           'attempts': 0,
+           'submitted': time.time()}
+    store.save(job)
+
+    # the lock is taken before the fork and inherited by the background process,
+    # so a fetch can never mistake a job that is just starting for a crashed one
+    lock = store.lock(job['id'])
+    if os.fork():
+        os.close(lock)
+        return job['id']
+
+    # background process - detach from the caller (PDI waits for stdout to close)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    log = os.open(store.path(job['id'], 'log'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    try:
+        job = run_job(create_session(len(OUTPUT_TYPES)), job, store, options)
+        options.timings.write_textfile()
+    except Exception:
+        logging.exception("job %s crashed" % job['id'])
+        os._exit(1)
+    os._exit(0 if job['status'] == 'done' else 1)
+
+
+# collect a job - waiting up to --wait seconds for it to finish, and resuming it
+# here if it failed or the process running it has gone away
+def fetch_job(job_id, store, options):
+
+    deadline = time.time() + options.wait
+    interval = 1.0
+    while True:
+        job = store.load(job_id)
+        if job['status'] == 'done':
+            return job
+
+        lock = store.lock(job_id)
+        if lock is not None:
+            try:
+                job = store.load(job_id)
+                if not job['status'] == 'done':
+                    logging.info("resuming job %s (%s) from the %s phase" % (job_id, job['status'], job['phase']))
+                    job = run_job(create_session(len(OUTPUT_TYPES)), job, store, options)
+            finally:
+                os.close(lock)
+            return job
+
+        if time.time() >= deadline:
+            return job
+        time.sleep(min(interval, max(0.1, deadline - time.time())))
+        interval = min(interval * 2, 30.0)
+
+
+# exit status of --fetch while the job is still running (EX_TEMPFAIL)
+JOB_PENDING = 75
+
+
+# socket of the runner daemon - override with --socket or PENTAHO_SAIKU_SOCKET
+DAEMON_SOCKET = os.environ.get('PENTAHO_SAIKU_SOCKET', '/tmp/pentaho_saiku_run.sock')
+
+# options that a client passes through to the daemon for its query run
+# prints the generated file names for the calling PDI transformation, one per line
+# or joined by --file-separator so that ExecProcess sees a single line to split
+def print_files(report_files, options):
+    if options.file_separator:
+        print(options.file_separator.join(report_files))
+    else:
+        for report_file in report_files:
+            print(report_file)
+
+
+DAEMON_RUN_OPTIONS = ['timeout', 'refresh', 'freshness', 'preview', 'preview_rows', 'no_cache',
+                      'spool_dir', 'compress', 'split_size', 'no_index']
+
+
+# seconds allowed on top of the query's own time limit for the daemon to queue
+# the query and write its reply
+DISPATCH_MARGIN = 60.0
+
+
+# how long to wait for the daemon's reply - the --timeout deadline, or failing
+# that a read timeout for each call the query makes, plus DISPATCH_MARGIN
+def dispatch_timeout(query, options):
+    if options.timeout:
+        return options.timeout + DISPATCH_MARGIN
+    if options.read_timeout:
+        calls = 2 + len(query['type'].split(','))
+        return calls * (options.connect_timeout + options.read_timeout) + DISPATCH_MARGIN
+    return None
+
+
+# hand a query to the runner daemon - returns its result record, or None
+# when there is no daemon listening so the query must be run here
+def dispatch_query(query, options):
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(options.socket)
+    except socket.error:
+        sock.close()
+        return None
+    timeout = dispatch_timeout(query, options)
+    sock.settimeout(timeout)
+
+    request = {'query': dict((k, query[k]) for k in ('name', 'solution', 'path', 'type', 'url', 'params')),
+               'user': options.user,
+               'passwd': options.passwd,
+               'options': dict((k, getattr(options, k)) for k in DAEMON_RUN_OPTIONS)}
+    try:
+        fh = sock.makefile('rwb')
+        fh.write(json.dumps(request) + "\n")
+        fh.flush()
+        reply = fh.readline()
+        fh.close()
+    except socket.timeout:
+        raise RunError("Runner daemon did not reply within %.0fs" % timeout)
+    finally:
+        sock.close()
+    if not reply:
+        raise RunError("Runner daemon closed the connection")
+    return json.loads(reply)
+
+
+# run a query handed over by a client, with the client's credentials
+def serve_query(server, request):
+
+    options = copy.copy(server.options)
+    options.user = request['user']
+    options.passwd = request['passwd']
+    options.generate_file = True
+    for k, v in (request.get('options') or {}).items():
+        if k in DAEMON_RUN_OPTIONS:
+            setattr(options, k, v)
+    if options.no_cache:
+        options.cache = None
+    if options.no_index:
+        options.index = None
+
+    query = request['query']
+    query['url'] = query['url'].rstrip('/')
+    with server.workers:
+        record = run_record(server.session, query, options)
+    options.timings.write_textfile()
+    return record
+
+
+# one connection is one query - a JSON request line in and a JSON result record line out
+class DaemonHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # a probe to see if the daemon is alive
+            return
+        try:
+            request = json.loads(line)
+            logging.info("request for: " + str(request['query'].get('name')))
+            reply = serve_query(self.server, request)
+        except Exception as e:
+            logging.exception("request failed")
+            reply = {'status': 'error', 'error': str(e)}
+        try:
+            self.wfile.write(json.dumps(reply) + "\n")
+        except socket.error as e:
+            logging.warn("client went away before its reply could be sent: " + str(e))
+
+
+class RunnerDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+# run as a daemon - queries are taken from clients over a unix socket and run
+# on a warm pool of workers sharing one pooled HTTP session
+def serve(options):
+
+    if os.path.exists(options.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(options.socket)
+            probe.close()
+            logging.error("A runner daemon is already listening on: " + options.socket)
+            sys.exit(1)
+        except socket.error:
+            # left behind by a daemon that died
+            probe.close()
+            os.unlink(options.socket)
+
+    # the socket carries Pentaho passwords, so only its owner may connect
+    umask = os.umask(0o077)
+    try:
+        server = RunnerDaemon(options.socket, DaemonHandler)
+    finally:
+        os.umask(umask)
+    server.options = options
+    server.session = create_session(options.workers * len(OUTPUT_TYPES))
+    server.workers = threading.BoundedSemaphore(options.workers)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info("runner daemon listening on %s with %d workers" % (options.socket, options.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
 
 
 # main of application
@@ -60,9 +1827,83 @@ def main():
     parser.add_option("-l", "--url", dest="url", default=None, type="string",
                           help="Pentaho host URL", metavar="URL")
     parser.add_option("-t", "--type", dest="output_type", default='pdf', type="string",
-                          help="Report output type - csv, xls or pdf", metavar="URL")
+                          help="Report output type - csv, xls or pdf, or a comma separated list of them", metavar="TYPE")
     parser.add_option("-g", "--generate", dest="generate_file", default=False, action="store_true",
                   help="Generate file and write filename to stdout", metavar="GENERATE_FILE")
+    parser.add_option("-k", "--chunk-size", dest="chunk_size", default=65536, type="int",
+                          help="Export download chunk size in bytes", metavar="CHUNK_SIZE")
+    parser.add_option("--spool-dir", dest="spool_dir", default='/tmp', type="string",
+                          help="Directory the generated files are written to", metavar="SPOOL_DIR")
+    parser.add_option("--compress", dest="compress", default=None, type="choice", choices=['gzip', 'zip'],
+                          help="Compress the output - gzip or zip (zip requires --generate)", metavar="COMPRESS")
+    parser.add_option("--file-separator", dest="file_separator", default=None, type="string",
+                          help="Print the generated file names on one line separated by SEP instead of one per line", metavar="SEP")
+    parser.add_option("--split-size", dest="split_size", default=0, type="int",
+                          help="Split CSV output into files of at most this many MB, each with the header row", metavar="MB")
+    parser.add_option("-b", "--batch", dest="batch", default=None, type="string",
+                          help="Batch manifest of queries to run (- for stdin)", metavar="MANIFEST")
+    parser.add_option("-w", "--workers", dest="workers", default=1, type="int",
+                          help="Number of batch queries to run in parallel", metavar="WORKERS")
+    parser.add_option("-m", "--max-per-server", dest="max_per_server", default=4, type="int",
+                          help="Maximum queries in flight against each Pentaho URL", metavar="MAX_PER_SERVER")
+    parser.add_option("-T", "--timeout", dest="timeout", default=0, type="float",
+                          help="Seconds each query is allowed to run for (0 for no limit)", metavar="TIMEOUT")
+    parser.add_option("--cache-dir", dest="cache_dir", default='/tmp/pentaho_saiku_cache', type="string",
+                          help="Directory for cached exports", metavar="CACHE_DIR")
+    parser.add_option("--cache-ttl", dest="cache_ttl", default=900, type="int",
+                          help="Seconds a cached export is valid for", metavar="CACHE_TTL")
+    parser.add_option("--cache-size", dest="cache_size", default=1024, type="int",
+                          help="Maximum size of the export cache in MB", metavar="CACHE_SIZE")
+    parser.add_option("--freshness", dest="freshness", default=None, type="string",
+                          help="Data freshness token - exports cached under another token are not reused", metavar="FRESHNESS")
+    parser.add_option("--no-cache", dest="no_cache", default=False, action="store_true",
+                  help="Do not use the export cache", metavar="NO_CACHE")
+    parser.add_option("--refresh", dest="refresh", default=False, action="store_true",
+                  help="Re-run queries and replace their cached exports", metavar="REFRESH")
+    parser.add_option("--preview", dest="preview", default='probe', type="choice", choices=['probe', 'full', 'skip'],
+                          help="Saiku Analytics result fetch before export - probe, full or skip", metavar="PREVIEW")
+    parser.add_option("--preview-rows", dest="preview_rows", default=1, type="int",
+                          help="Rows fetched by the result probe", metavar="PREVIEW_ROWS")
+    parser.add_option("-P", "--param", dest="param", default=[], action="append", type="string",
+                          help="Report parameter or filter value NAME=VALUE - repeat for multiple values", metavar="PARAM")
+    parser.add_option("-x", "--matrix", dest="matrix", default=None, type="string",
+                          help="CSV parameter matrix - each query is run once per row", metavar="MATRIX")
+    parser.add_option("--template-ttl", dest="template_ttl", default=0, type="int",
+                          help="Seconds fetched report definitions are kept on disk (0 for this run only)", metavar="TEMPLATE_TTL")
+    parser.add_option("--index", dest="build_index", default=False, action="store_true",
+                  help="Crawl the Pentaho repository at --url into the report index", metavar="INDEX")
+    parser.add_option("--list", dest="list_index", default=False, action="store_true",
+                  help="List the indexed reports (of --url) as batch manifest lines", metavar="LIST")
+    parser.add_option("--index-file", dest="index_file", default=None, type="string",
+                          help="Report index file (default repository.db in --cache-dir)", metavar="INDEX_FILE")
+    parser.add_option("--no-index", dest="no_index", default=False, action="store_true",
+                  help="Do not check queries against the report index", metavar="NO_INDEX")
+    parser.add_option("--timings", dest="timings", default=None, type="string",
+                          help="Append per phase timings of each query run as JSON lines to this file (- for stderr)", metavar="TIMINGS")
+    parser.add_option("--prom-textfile", dest="prom_textfile", default=None, type="string",
+                          help="Write per phase timings as a Prometheus node exporter textfile", metavar="PROM_TEXTFILE")
+    parser.add_option("--connect-timeout", dest="connect_timeout", default=30.0, type="float",
+                          help="Seconds to wait for a connection to Pentaho (0 for no limit)", metavar="CONNECT_TIMEOUT")
+    parser.add_option("--read-timeout", dest="read_timeout", default=3600.0, type="float",
+                          help="Seconds to wait for Pentaho to send data (0 for no limit)", metavar="READ_TIMEOUT")
+    parser.add_option("--submit", dest="submit", default=False, action="store_true",
+                  help="Run the query in the background and write its job id to stdout", metavar="SUBMIT")
+    parser.add_option("--fetch", dest="fetch", default=None, type="string",
+                          help="Collect the files generated by a submitted job", metavar="JOB_ID")
+    parser.add_option("--wait", dest="wait", default=0, type="float",
+                          help="Seconds --fetch waits for a running job to finish", metavar="WAIT")
+    parser.add_option("--state-dir", dest="state_dir", default='/tmp/pentaho_saiku_jobs', type="string",
+                          help="Directory for the state of submitted jobs", metavar="STATE_DIR")
+    parser.add_option("--retries", dest="retries", default=3, type="int",
+                          help="Times a submitted job retries a failed call", metavar="RETRIES")
+    parser.add_option("--backoff", dest="backoff", default=2.0, type="float",
+                          help="Seconds before the first retry - doubled for each retry after", metavar="BACKOFF")
+    parser.add_option("--serve", dest="serve", default=False, action="store_true",
+                  help="Run as a daemon taking queries from clients on --socket", metavar="SERVE")
+    parser.add_option("--socket", dest="socket", default=DAEMON_SOCKET, type="string",
+                          help="Unix socket of the runner daemon", metavar="SOCKET")
+    parser.add_option("--no-daemon", dest="no_daemon", default=False, action="store_true",
+                  help="Always run the query in this process, even when a daemon is listening", metavar="NO_DAEMON")
     parser.add_option("-d", "--debug", dest="debug", default=False, action="store_true",
                   help="Switch on debugging", metavar="DEBUG")
     (options, args) = parser.parse_args()
@@ -77,170 +1918,202 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
 
-    if options.query_name == None or options.url == None or options.user == None or options.passwd == None :
-        logging.error("Minimum paramters not supplied: url, name, solution, user, passwd")
+    if not options.serve and not options.list_index and \
+       ((options.query_name == None and options.batch == None and options.fetch == None and not options.build_index) or \
+        options.url == None or options.user == None or options.passwd == None) :
+        logging.error("Minimum paramters not supplied: url, name (or batch, fetch or index), solution, user, passwd")
         sys.exit(1)
 
-    # set default to adhoc queries
-    if not re.match(r'^.*?\.\w+$', options.query_name) :
-        options.query_name = options.query_name + '.adhoc'
+    if options.chunk_size < 1:
+        logging.error("Chunk size must be a positive number of bytes")
+        sys.exit(1)
+
+    if options.split_size < 0:
+        logging.error("Split size must be a positive number of MB (or 0 to not split)")
+        sys.exit(1)
 
-    if not re.match(r'^.*?\.(adhoc|saiku)$', options.query_name) :
-        logging.error("Query name (%s) must be the repository file and end in either .adhoc or .saiku" % options.query_name)
+    if not os.path.isdir(options.spool_dir):
+        logging.error("Spool directory does not exist: " + options.spool_dir)
         sys.exit(1)
 
-    rep_type = options.query_name.split('.')[-1]
+    if options.preview_rows < 1:
+        logging.error("Preview rows must be at least 1 - use --preview=full to fetch the entire result")
+        sys.exit(1)
 
-    if not options.output_type == 'csv' and not options.output_type == 'xls' and not options.output_type == 'pdf':
-        logging.error("Type must be xls, csv or pdf")
+    if options.workers < 1 or options.max_per_server < 1:
+        logging.error("Workers and max per server must be at least 1")
         sys.exit(1)
 
+    if options.url:
+        options.url = options.url.rstrip('/')
 
-    logging.debug("options are: " + str(options))
+    if not options.index_file:
+        options.index_file = os.path.join(options.cache_dir, 'repository.db')
 
-    if options.path == None:
-        options.path = ""
+    HTTP_TIMEOUT['connect'] = options.connect_timeout
+    HTTP_TIMEOUT['read'] = options.read_timeout
 
-    if options.solution == None:
-        options.solution = ""
+    options.params = {}
+    for param in options.param:
+        if not '=' in param:
+            logging.error("Parameters must be given as NAME=VALUE: " + param)
+            sys.exit(1)
+        name, value = param.split('=', 1)
+        options.params.setdefault(name.strip(), []).append(value)
+
+    logging.debug("options are: " + str(options))
 
     # set the encoding to stop errors on the input/putput streams
     reload(sys)
     sys.setdefaultencoding("utf-8")
 
-    rep_uuid = str(uuid.uuid1()).upper()
+    if options.list_index:
+        out = csv.writer(sys.stdout, lineterminator="\n")
+        for entry in RepositoryIndex(options.index_file).entries(options.url):
+            out.writerow([entry[3], entry[1], entry[2], options.output_type, entry[0]])
+        sys.exit(0)
 
-    if rep_type == 'adhoc' :
-        # look up the report definition
-        definition_url = options.url + "/content/saiku-adhoc/rest/repository/query/" + \
-            options.query_name + "?name=" + options.query_name + \
-            "&solution=" + str(options.solution) + "&path=" + str(options.path) + \
-            "&action=" + options.query_name + \
-            "&userid=" + options.user + "&password=" + options.passwd
-
-        headers = {'content-type': 'application/json',
-                   'accept': 'application/json, text/javascript, */*; q=0.01'}
-        res = requests.get(definition_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to lookup report failed: " + str(res.status_code) + ": " + str(res.reason))
-            sys.exit(1)
-        logging.debug("content: " + res.text)
-        # payload = json.loads(res.text)
-
-        # create the report instance
-        payload = re.sub(r'"name":".*?",', '', res.content, 1)
-        for t in ["newname", 'lastModified', 'solution', 'action', 'path']:
-            payload = re.sub(r'"' + t + '":.*?,', '', payload, 1)
-        payload = re.sub(r',"overwrite":.*?}', '}', payload, 1)
-        logging.debug("json: " + str(payload))
-
-        create_url = options.url + "/content/saiku-adhoc/rest/query/" + rep_uuid + \
-            "?userid=" + options.user + "&password=" + options.passwd
-        res = requests.post(create_url, headers=headers, data=payload)
-        if not res.status_code == 200:
-            logging.error("Call to create report instance failed: " + str(res.status_code) + ": " + str(res.reason))
+    # a single generated report is handed to the runner daemon when there is one
+    if options.generate_file and options.query_name and not options.no_daemon and not options.serve and \
+       not (options.batch or options.matrix or options.submit or options.fetch):
+        try:
+            query = normalise_query({'name': options.query_name,
+                                     'solution': options.solution,
+                                     'path': options.path,
+                                     'type': options.output_type,
+                                     'url': options.url,
+                                     'params': options.params})
+            record = dispatch_query(query, options)
+        except (RunError, socket.error, ValueError) as e:
+            logging.error(str(e))
             sys.exit(1)
-        # logging.debug("content: " + res.text)
+        if record:
+            if not record['status'] == 'ok':
+                logging.error(record.get('error'))
+                sys.exit(1)
+            print_files(record['files'], options)
+            sys.exit(0)
 
-        # run the report
-        report_url = options.url + "/content/saiku-adhoc/rest/query/" + rep_uuid + \
-            "/report/1?_=" + str(int(time.time())) + \
-            "&userid=" + options.user + "&password=" + options.passwd
+    load_requests()
 
-        headers = {}
-        res = requests.get(report_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to run report failed: " + str(res.status_code) + ": " + str(res.reason))
-            sys.exit(1)
-        # logging.debug("content: " + res.text)
+    options.cache = None
+    if not options.no_cache and options.cache_ttl > 0 and options.cache_size > 0:
+        try:
+            options.cache = ResultCache(options.cache_dir, options.cache_ttl, options.cache_size * 1024 * 1024)
+        except OSError as e:
+            logging.warn("export cache disabled - cannot use %s: %s" % (options.cache_dir, str(e)))
 
-        # Now generate the requested output type
-        report_url = options.url + "/content/saiku-adhoc/rest/export/" + rep_uuid + \
-            "/" + options.output_type + \
-            "?userid=" + options.user + "&password=" + options.passwd
+    options.timings = PhaseTimings(options.timings, options.prom_textfile)
 
-        headers = {}
-        res = requests.get(report_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to run report failed: " + str(res.status_code) + ": " + str(res.reason))
-            sys.exit(1)
-        logging.debug("result: " + res.text)
+    # the daemon only reuses definitions in memory for --template-ttl seconds
+    max_age = options.template_ttl if options.serve else None
+    options.templates = TemplateCache(max_age=max_age)
+    if options.template_ttl > 0:
+        try:
+            options.templates = TemplateCache(os.path.join(options.cache_dir, 'templates'), options.template_ttl, max_age)
+        except OSError as e:
+            logging.warn("definition cache disabled - cannot use %s: %s" % (options.cache_dir, str(e)))
 
-        if options.generate_file:
-            report_file = '/tmp/' + re.sub(r'%..', '', re.sub(r'.*?\/', '', options.query_name)) + '-' + time.strftime('%Y%m%d-%H%M%S', time.gmtime()) + '.' + options.output_type
-            # report_file = '/tmp/' + rep_uuid + '.' + options.output_type
-            f = open(report_file, 'w')
-            f.write(res.content)
-            f.close()
-            print(report_file)
-        else:
-            print(res.content)
+    options.index = None
+    if not options.no_index:
+        options.index = RepositoryIndex(options.index_file)
+        options.templates.index = options.index
 
-    else:
-        # saiku analytics queries
-        # look up the report definition
-        filename = ""
-        if len(str(options.solution)) > 0:
-            filename = options.solution + '%2F'
-        filename += options.query_name
-        definition_url = options.url + "/content/saiku/admin/pentahorepository2/resource?file=" + filename + \
-            "&userid=" + options.user + "&password=" + options.passwd
-
-        headers = {'content-type': 'application/x-www-form-urlencoded',
-                   'accept': 'text/plain, */*; q=0.01'}
-        res = requests.get(definition_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to lookup report failed: " + str(res.status_code) + ": " + str(res.reason))
+    if options.build_index:
+        try:
+            indexed, fetched, removed = RepositoryIndex(options.index_file).refresh(create_session(), options.url, options)
+        except (RunError, requests.exceptions.RequestException, sqlite3.Error, OSError) as e:
+            logging.error("index failed: " + str(e))
             sys.exit(1)
-        logging.debug("content: " + res.text)
+        logging.info("indexed %d reports in %s - %d definitions fetched, %d removed" %
+                     (indexed, options.index_file, fetched, removed))
+        sys.exit(0)
 
-        # create the report instance
-        payload = {'xml': res.text, 'formatter': 'flattened', 'type': 'QM'}
-        logging.debug("parameters: " + str(payload))
-
-        headers = {'content-type': 'application/x-www-form-urlencoded',
-                   'accept': 'application/json, text/javascript, */*; q=0.01'}
-        create_url = options.url + "/content/saiku/admin/query/" + rep_uuid + \
-            "?userid=" + options.user + "&password=" + options.passwd
-        res = requests.post(create_url, headers=headers, data=payload)
-        if not res.status_code == 200:
-            logging.error("Call to create report instance failed: " + str(res.status_code) + ": " + str(res.reason))
-            sys.exit(1)
-        logging.debug("content: " + res.text)
+    if options.serve:
+        serve(options)
+        sys.exit(0)
 
-        # Now generate the requested output type
-        report_url = options.url + "/content/saiku/admin/query/" + rep_uuid + \
-            "/result/flattened?limit=0&_=" + str(int(time.time())) + \
-            "&userid=" + options.user + "&password=" + options.passwd
+    if options.submit or options.fetch:
+        # jobs always generate files
+        options.generate_file = True
+        try:
+            store = JobStore(options.state_dir)
+            if options.fetch:
+                job = fetch_job(options.fetch, store, options)
+            else:
+                query = normalise_query({'name': options.query_name,
+                                         'solution': options.solution,
+                                         'path': options.path,
+                                         'type': options.output_type,
+                                         'url': options.url,
+                                         'params': options.params})
+                if options.index:
+                    options.index.resolve(query)
+                print(submit_job(query, store, options))
+                sys.exit(0)
+        except (RunError, OSError) as e:
+            logging.error(str(e))
+            sys.exit(1)
+        options.timings.write_textfile()
 
-        headers = {}
-        res = requests.get(report_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to run report failed: " + str(res.status_code) + ": " + str(res.reason))
+        if job['status'] == 'done':
+            print_files([f for t in job['query']['type'].split(',') for f in job['files'][t]], options)
+            sys.exit(0)
+        elif job['status'] == 'failed':
+            logging.error("job %s failed: %s" % (job['id'], job.get('error')))
             sys.exit(1)
-        logging.debug("content: " + res.text)
+        logging.info("job %s is still running" % job['id'])
+        sys.exit(JOB_PENDING)
 
-        # Now generate the requested output type
-        report_url = options.url + "/content/saiku/admin/query/" + rep_uuid + \
-            "/export/" + options.output_type + \
-            "/flattened?userid=" + options.user + "&password=" + options.passwd
+    # room for each worker to download all of the output types at once
+    session = create_session(options.workers * len(OUTPUT_TYPES))
 
-        headers = {}
-        res = requests.get(report_url, headers=headers)
-        if not res.status_code == 200:
-            logging.error("Call to run report failed: " + str(res.status_code) + ": " + str(res.reason))
+    if options.batch or options.matrix:
+        # batch output always goes to files
+        options.generate_file = True
+        try:
+            if options.batch:
+                queries = read_manifest(options.batch, options)
+            else:
+                queries = [{'name': options.query_name,
+                            'solution': options.solution,
+                            'path': options.path,
+                            'type': options.output_type,
+                            'url': options.url,
+                            'params': options.params}]
+            if options.matrix:
+                queries = expand_matrix(queries, read_matrix(options.matrix))
+        except (IOError, csv.Error) as e:
+            logging.error("Could not read batch manifest or matrix: " + str(e))
             sys.exit(1)
-        logging.debug("result: " + res.text)
+        failed = run_batch(session, queries, options)
+        options.timings.write_textfile()
+        sys.exit(1 if failed else 0)
 
-        if options.generate_file:
-            report_file = '/tmp/' + re.sub(r'%..', '', re.sub(r'.*?\/', '', options.query_name)) + '-' + time.strftime('%Y%m%d-%H%M%S', time.gmtime()) + '.' + options.output_type
-            # report_file = '/tmp/' + rep_uuid + '.' + options.output_type
-            f = open(report_file, 'w')
-            f.write(res.content)
-            f.close()
-            print(report_file)
-        else:
-            print(res.content)
+    try:
+        query = normalise_query({'name': options.query_name,
+                                 'solution': options.solution,
+                                 'path': options.path,
+                                 'type': options.output_type,
+                                 'url': options.url,
+                                 'params': options.params})
+        if options.timeout:
+            query['deadline'] = time.time() + options.timeout
+        if len(query['types']) > 1 and not options.generate_file:
+            raise RunError("Multiple output types can only be used with --generate")
+        if (options.compress == 'zip' or options.split_size) and not options.generate_file:
+            raise RunError("zip compression and split output can only be used with --generate")
+        if options.index:
+            options.index.resolve(query)
+        with server_slot(query['url'], options.max_per_server):
+            report_files = run_query(session, query, options)
+    except (RunError, requests.exceptions.RequestException) as e:
+        logging.error(str(e))
+        options.timings.write_textfile()
+        sys.exit(1)
+    options.timings.write_textfile()
+
+    print_files(report_files, options)
 
     sys.exit(0)
 
@@ -248,4 +2121,3 @@ def main():
 # ------ Good Ol' main ------
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The export cache is optional - an export must never fail because the cache
+directory cannot be written.
+
+  python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pentaho_saiku_adhoc_run as runner
+
+
+class Options(object):
+    compress = None
+    split_size = 0
+    generate_file = True
+    chunk_size = 65536
+
+
+class UnwritableCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp(prefix='test_result_cache-')
+        self.options = Options()
+        self.options.spool_dir = os.path.join(self.work, 'spool')
+        os.mkdir(self.options.spool_dir)
+        self.cache_dir = os.path.join(self.work, 'cache')
+        self.options.cache = runner.ResultCache(self.cache_dir, 900, 1024 * 1024)
+        self.query = {'name': 'report.adhoc', 'type': 'csv', 'url': 'http://localhost/pentaho', 'params': {}}
+        self.key = self.options.cache.key(self.query, 'definition', None, 'admin')
+
+    def tearDown(self):
+        shutil.rmtree(self.work, True)
+
+    def export(self, chunks):
+        files = runner.write_report(chunks, self.query, self.options, self.key)
+        self.assertEqual(len(files), 1)
+        fh = open(files[0], 'rb')
+        data = fh.read()
+        fh.close()
+        return data
+
+    def test_entry_cannot_be_created(self):
+        # a file where the cache directory should be - even root cannot create entries in it
+        shutil.rmtree(self.cache_dir)
+        open(self.cache_dir, 'w').close()
+        self.assertEqual(self.export([b'a,b\n', b'1,2\n']), b'a,b\n1,2\n')
+        self.assertEqual(self.options.cache.get(self.key, 'csv'), None)
+
+    def test_entry_cannot_be_stored(self):
+        # the cache directory goes away while the export is downloading
+        def chunks():
+            yield b'a,b\n'
+            shutil.rmtree(self.cache_dir)
+            yield b'1,2\n'
+        self.assertEqual(self.export(chunks()), b'a,b\n1,2\n')
+        self.assertEqual(self.options.cache.get(self.key, 'csv'), None)
+
+    def test_entry_cannot_be_written(self):
+        class Full(object):
+            def write(self, data):
+                raise IOError(28, 'No space left on device')
+            def close(self):
+                pass
+        part = os.path.join(self.cache_dir, self.key + '.csv.part')
+        self.options.cache.open_entry = lambda key, output_type: (part, Full())
+        self.assertEqual(self.export([b'a,b\n', b'1,2\n']), b'a,b\n1,2\n')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
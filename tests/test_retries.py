@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Only connection errors and server (5xx) errors are retried, and never past the
+query deadline.
+
+  python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pentaho_saiku_adhoc_run as runner
+
+
+class RequestException(IOError):
+    pass
+
+
+class Requests(object):
+    class exceptions(object):
+        RequestException = RequestException
+
+
+class Options(object):
+    retries = 3
+    backoff = 0.01
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = runner.requests
+        runner.requests = Requests
+        self.calls = 0
+
+    def tearDown(self):
+        runner.requests = self.requests
+
+    def failing(self, error):
+        def fn():
+            self.calls += 1
+            raise error
+        return fn
+
+    def test_server_error_is_retried(self):
+        self.assertRaises(runner.RunError, runner.with_retries, Options(), "run report",
+                          self.failing(runner.RunError("Call to run report failed: 503", 503)))
+        self.assertEqual(self.calls, Options.retries + 1)
+
+    def test_connection_error_is_retried(self):
+        self.assertRaises(RequestException, runner.with_retries, Options(), "run report",
+                          self.failing(RequestException("Connection refused")))
+        self.assertEqual(self.calls, Options.retries + 1)
+
+    def test_other_errors_are_not_retried(self):
+        for error in [runner.RunError("Call to run report failed: 404", 404),
+                      runner.RunError("Query timed out"),
+                      ValueError("No JSON object could be decoded")]:
+            self.calls = 0
+            self.assertRaises(type(error), runner.with_retries, Options(), "run report", self.failing(error))
+            self.assertEqual(self.calls, 1)
+
+    def test_no_retry_past_deadline(self):
+        options = Options()
+        options.backoff = 60
+        start = time.time()
+        self.assertRaises(runner.RunError, runner.with_retries, options, "run report",
+                          self.failing(runner.RunError("Call to run report failed: 503", 503)), start + 30)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(time.time() - start < 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,7 +13,14 @@ from flask.ext.login import (LoginManager, current_user, login_required,
                             confirm_login, fresh_login_required)
 from flask.ext.sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.mysql import BIT
+import sqlalchemy
 import base64
+from optparse import OptionParser
+import threading
+import time
+import json
+import csv
+import sys
 
 class User(UserMixin):
     def __init__(self, name, fullname, active=True):
@@ -51,6 +58,8 @@ class DBUser(db.Model):
     PASSWORD = db.Column(db.String(50), unique=False)
     DESCRIPTION = db.Column(db.String(120), unique=False)
     ENABLED = db.Column(BIT(1))
+    # keyset pages of /users sorted by description walk this index
+    __table_args__ = (db.Index('USERS_DESCRIPTION_USERNAME', 'DESCRIPTION', 'USERNAME'),)
 
     def __init__(self, username, password, description):
         self.USERNAME = username
@@ -66,6 +75,8 @@ class DBGrantedAuthorities(db.Model):
     __tablename__ = 'GRANTED_AUTHORITIES'
     USERNAME = db.Column(db.String(50), primary_key=True)
     AUTHORITY = db.Column(db.String(50), primary_key=True)
+    # the primary key covers a user's groups - this covers a group's users
+    __table_args__ = (db.Index('GRANTED_AUTHORITIES_AUTHORITY_USERNAME', 'AUTHORITY', 'USERNAME'),)
 
     def __init__(self, username, authority):
         self.USERNAME = username
@@ -89,6 +100,399 @@ class DBAuthorities(db.Model):
 
 
 
+def create_indexes():
+    """Add the indexes declared on the models that the hibernate tables are missing -
+    Pentaho creates the tables, so db.create_all() is never run against them."""
+    inspector = sqlalchemy.inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if not index.name in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+USER_SORTS = {'username': [DBUser.USERNAME],
+              'description': [DBUser.DESCRIPTION, DBUser.USERNAME]}
+
+
+def like_escape(text):
+    """Escape the LIKE wildcards in a search string."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def after_key(columns, values, descending):
+    """The keyset condition for the rows after values in the (columns) sort order.
+    Only the leading column may be NULL - MySQL sorts NULLs first, so they come
+    before every other value ascending and after them descending."""
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value if descending else column > value
+    rest = after_key(columns[1:], values[1:], descending)
+    if value is None:
+        if descending:
+            return db.and_(column.is_(None), rest)
+        return db.or_(column.isnot(None), db.and_(column.is_(None), rest))
+    past = column < value if descending else column > value
+    if descending:
+        past = db.or_(past, column.is_(None))
+    return db.or_(past, db.and_(column == value, rest))
+
+
+def is_enabled(value):
+    """ENABLED is BIT(1) - 1 through the models, and b'\x01' from raw SQL."""
+    return value in (1, True, b'\x01')
+
+
+def user_page(args):
+    """One keyset page of users for the /users search args - returns the rows, the
+    cursor of the next page (or None) and the settings the page was made with."""
+    search = args.get('q', '').strip()
+    match = args.get('match', 'prefix')
+    sort = args.get('sort', 'username')
+    order = args.get('order', 'asc')
+    try:
+        limit = min(max(int(args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+    if not match in ('prefix', 'substring') or not sort in USER_SORTS or not order in ('asc', 'desc'):
+        flask.abort(400)
+    columns = USER_SORTS[sort]
+    descending = order == 'desc'
+
+    # the password never leaves the database
+    query = db.session.query(DBUser.USERNAME, DBUser.DESCRIPTION, DBUser.ENABLED)
+    if search:
+        if match == 'prefix':
+            # a range scan of the primary key
+            query = query.filter(DBUser.USERNAME.like(like_escape(search) + '%', escape='\\'))
+        else:
+            pattern = '%' + like_escape(search) + '%'
+            query = query.filter(db.or_(DBUser.USERNAME.like(pattern, escape='\\'),
+                                        DBUser.DESCRIPTION.like(pattern, escape='\\')))
+    if args.get('after'):
+        values = decode_cursor(args['after'], len(columns))
+        if values is None:
+            flask.abort(400)
+        query = query.filter(after_key(columns, values, descending))
+    query = query.order_by(*[c.desc() if descending else c.asc() for c in columns])
+
+    # one row more than the page says whether there is another
+    rows = query.limit(limit + 1).all()
+    after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        after = encode_cursor([getattr(rows[-1], c.key) for c in columns])
+    settings = {'q': search, 'match': match, 'sort': sort, 'order': order, 'limit': limit}
+    return rows, after, settings
+
+
+def member_page(group, args):
+    """One keyset page of a group's users, with an optional username prefix - a range
+    scan of the (AUTHORITY, USERNAME) index however big the group is.  Returns the
+    rows, the cursor of the next page (or None) and the settings."""
+    search = args.get('q', '').strip()
+    try:
+        limit = min(max(int(args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+    query = db.session.query(DBGrantedAuthorities.USERNAME, DBUser.DESCRIPTION, DBUser.ENABLED).outerjoin(
+        DBUser, DBUser.USERNAME == DBGrantedAuthorities.USERNAME).filter(DBGrantedAuthorities.AUTHORITY == group)
+    if search:
+        query = query.filter(DBGrantedAuthorities.USERNAME.like(like_escape(search) + '%', escape='\\'))
+    if args.get('after'):
+        values = decode_cursor(args['after'], 1)
+        if values is None:
+            flask.abort(400)
+        query = query.filter(DBGrantedAuthorities.USERNAME > values[0])
+    rows = query.order_by(DBGrantedAuthorities.USERNAME).limit(limit + 1).all()
+    after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        after = encode_cursor([rows[-1].USERNAME])
+    return rows, after, {'q': search, 'limit': limit}
+
+
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 1000
+
+
+class UserCache(object):
+    """The logged in users loaded for each request, kept for USER_CACHE_TTL seconds so
+    page loads do not each go to the database.  Each process has its own cache, so a
+    change made elsewhere shows within the TTL - changes made here invalidate at once."""
+
+    def __init__(self, ttl=USER_CACHE_TTL, size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        now = time.time()
+        with self.lock:
+            cached = self.users.get(username)
+        if cached and cached[0] > now:
+            return cached[1]
+        u = db.session.query(DBUser.USERNAME, DBUser.DESCRIPTION).filter_by(USERNAME=username).first()
+        # a deleted user is remembered too, as None - which logs the session out
+        user = User(u.USERNAME, u.DESCRIPTION) if u else None
+        with self.lock:
+            if len(self.users) >= self.size:
+                for name in [n for n, c in self.users.items() if c[0] <= now] or list(self.users):
+                    del self.users[name]
+            self.users[username] = (now + self.ttl, user)
+        return user
+
+    def invalidate(self, username):
+        with self.lock:
+            self.users.pop(username, None)
+
+
+user_cache = UserCache()
+
+
+def update_grants(user=None, group=None, add=(), remove=(), replace=None):
+    """Change the groups of one user, or the users of one group - add and remove
+    (or replace, for the whole membership) name the other side of each grant.
+    Only grants that change are written, with at most one INSERT and one DELETE,
+    in the session's transaction.  Returns the (added, removed) names."""
+    table = DBGrantedAuthorities.__table__
+    if user is not None:
+        key_column, key, column = table.c.USERNAME, user, table.c.AUTHORITY
+    else:
+        key_column, key, column = table.c.AUTHORITY, group, table.c.USERNAME
+    query = db.select([column]).where(key_column == key)
+    if replace is None:
+        # only the grants asked about - a group may have thousands of users
+        names = set(add) | set(remove)
+        if not names:
+            return [], []
+        query = query.where(column.in_(sorted(names)))
+    current = set(r[0] for r in db.session.execute(query))
+    if replace is not None:
+        added, removed = set(replace) - current, current - set(replace)
+    else:
+        added, removed = set(add) - current, (set(remove) & current) - set(add)
+    added, removed = sorted(added), sorted(removed)
+    if added:
+        db.session.execute(table.insert(), [{key_column.name: key, column.name: name} for name in added])
+    if removed:
+        db.session.execute(table.delete().where(key_column == key).where(column.in_(removed)))
+    return added, removed
+
+
+IMPORT_CHUNK = 500
+IMPORT_FIELDS = ['username', 'password', 'description', 'enabled', 'groups']
+
+
+def read_import(fh, format):
+    """The user records of a CSV (a header row naming IMPORT_FIELDS - groups separated by ;)
+    or JSON (a list of records, or {"users": [...]}) import file."""
+    if format == 'json':
+        data = json.load(fh)
+        return data['users'] if isinstance(data, dict) else data
+    rows = []
+    for row in csv.DictReader(fh):
+        # an empty cell leaves the user's setting as it is
+        row = dict((k.strip().lower(), (v or '').decode('utf-8').strip() or None) for k, v in row.items() if k)
+        row['groups'] = [g.strip() for g in (row.get('groups') or '').split(';') if g.strip()]
+        rows.append(row)
+    return rows
+
+
+def import_text(record, field, line):
+    """An import record's text field, or None when it is not given."""
+    value = record.get(field)
+    if value is not None and not isinstance(value, basestring):
+        raise ValueError('record %d: %s must be a string' % (line, field))
+    return value
+
+
+def import_record(record, line):
+    """Check and normalise one import record - raises ValueError naming the record."""
+    if not isinstance(record, dict):
+        raise ValueError('record %d is not an object' % line)
+    username = (import_text(record, 'username', line) or '').strip()
+    if len(username) < 3 or len(username) > 50:
+        raise ValueError('record %d: username invalid' % line)
+    password = import_text(record, 'password', line) or ''
+    if password and len(password) <= 5:
+        raise ValueError('record %d: password for %s is too short' % (line, username))
+    description = import_text(record, 'description', line)
+    if description is not None and (len(description) < 3 or len(description) > 120):
+        raise ValueError('record %d: description for %s invalid' % (line, username))
+    enabled = record.get('enabled')
+    if enabled in (None, ''):
+        enabled = None
+    elif str(enabled).lower() in ('1', 'true', 'yes', 'on'):
+        enabled = 1
+    elif str(enabled).lower() in ('0', 'false', 'no', 'off'):
+        enabled = 0
+    else:
+        raise ValueError('record %d: enabled for %s must be 1 or 0' % (line, username))
+    groups = record.get('groups') or []
+    if not isinstance(groups, list) or [g for g in groups if not isinstance(g, basestring) or not g or len(g) > 50]:
+        raise ValueError('record %d: groups for %s invalid' % (line, username))
+    # names compare without case in the database, so a group given twice is granted once
+    seen = set()
+    groups = [g for g in groups if not (g.lower() in seen or seen.add(g.lower()))]
+    return {'username': username, 'password': password.encode('utf-8'), 'description': description,
+            'enabled': enabled, 'groups': groups}
+
+
+def import_users(records, dry_run=False, chunk=IMPORT_CHUNK):
+    """Create or update users, and add them to groups (created as needed), from import
+    records.  Each chunk of users is read with one query per table and written with
+    one batched statement per kind of change, and the whole import is one transaction.
+    Users and grants are only added to - an existing user keeps the groups and settings
+    not given.  User and group names are matched without case, as the database does.
+    Returns the counts, the diff of what changed (or would, with dry_run) and the rate.
+    Every record is checked before anything is written - any error fails the whole
+    import, except with dry_run, where the records in error are listed in the diff."""
+    start = time.time()
+    errors = []
+    users = []
+    for line, record in enumerate(records, 1):
+        try:
+            users.append(dict(import_record(record, line), line=line))
+        except ValueError as e:
+            errors.append({'user': record.get('username') if isinstance(record, dict) else None,
+                           'action': 'error', 'error': str(e)})
+    # a user given twice is imported as it was given last
+    users = dict((u['username'].lower(), u) for u in users).values()
+    users.sort(key=lambda u: u['username'].lower())
+
+    users_table = DBUser.__table__
+    grants_table = DBGrantedAuthorities.__table__
+    authorities_table = DBAuthorities.__table__
+
+    # users without a password must already exist
+    unset = [u['username'] for u in users if not u['password']]
+    existing = set()
+    for i in range(0, len(unset), chunk):
+        existing.update(r[0].lower() for r in db.session.execute(
+            db.select([users_table.c.USERNAME]).where(users_table.c.USERNAME.in_(unset[i:i + chunk]))))
+    for u in users:
+        if not u['password'] and not u['username'].lower() in existing:
+            errors.append({'user': u['username'], 'action': 'error',
+                           'error': 'record %d: new user %s has no password' % (u['line'], u['username'])})
+    if errors and not dry_run:
+        messages = [e['error'] for e in errors]
+        raise ValueError('; '.join(messages[:20]) + (' ...' if len(messages) > 20 else ''))
+    failed = set(e['user'] for e in errors)
+    users = [u for u in users if not u['username'] in failed]
+
+    result = {'users_created': 0, 'users_updated': 0, 'users_unchanged': 0,
+              'groups_created': 0, 'grants_added': 0, 'errors': len(errors), 'diff': list(errors)}
+    updated = []
+    try:
+        # groups first - grants refer to them
+        wanted = sorted(dict((g.lower(), g) for u in reversed(users) for g in u['groups']).values())
+        existing = set()
+        for i in range(0, len(wanted), chunk):
+            existing.update(r[0].lower() for r in db.session.execute(
+                db.select([authorities_table.c.AUTHORITY]).where(authorities_table.c.AUTHORITY.in_(wanted[i:i + chunk]))))
+        new_groups = [g for g in wanted if not g.lower() in existing]
+        result['groups_created'] = len(new_groups)
+        result['diff'] += [{'group': g, 'action': 'create'} for g in new_groups]
+        if new_groups and not dry_run:
+            db.session.execute(authorities_table.insert(), [{'AUTHORITY': g, 'DESCRIPTION': g} for g in new_groups])
+
+        for i in range(0, len(users), chunk):
+            batch = users[i:i + chunk]
+            names = [u['username'] for u in batch]
+            current = dict((r.USERNAME.lower(), r) for r in db.session.execute(
+                db.select([users_table.c.USERNAME, users_table.c.PASSWORD, users_table.c.DESCRIPTION,
+                           users_table.c.ENABLED]).where(users_table.c.USERNAME.in_(names))))
+            granted = set((r.USERNAME.lower(), r.AUTHORITY.lower()) for r in db.session.execute(
+                db.select([grants_table.c.USERNAME, grants_table.c.AUTHORITY]).where(grants_table.c.USERNAME.in_(names))))
+
+            inserts, updates, grants = [], [], []
+            for u in batch:
+                password = base64.b64encode(u['password']) if u['password'] else None
+                row = current.get(u['username'].lower())
+                if row is None:
+                    if not password:
+                        # deleted since the records were checked
+                        raise ValueError('new user %s has no password' % u['username'])
+                    inserts.append({'USERNAME': u['username'], 'PASSWORD': password,
+                                    'DESCRIPTION': u['description'] if u['description'] is not None else u['username'],
+                                    'ENABLED': 1 if u['enabled'] is None else u['enabled']})
+                    entry = {'user': u['username'], 'action': 'create'}
+                else:
+                    changes = {}
+                    if password and password != row.PASSWORD:
+                        # the diff never shows a password
+                        changes['password'] = 'changed'
+                    if u['description'] is not None and u['description'] != row.DESCRIPTION:
+                        changes['description'] = [row.DESCRIPTION, u['description']]
+                    if u['enabled'] is not None and u['enabled'] != int(is_enabled(row.ENABLED)):
+                        changes['enabled'] = [int(is_enabled(row.ENABLED)), u['enabled']]
+                    entry = {'user': u['username'], 'action': 'update', 'changes': changes}
+                    if changes:
+                        updates.append({'b_username': u['username'],
+                                        'b_password': password or row.PASSWORD,
+                                        'b_description': u['description'] if u['description'] is not None else row.DESCRIPTION,
+                                        'b_enabled': int(is_enabled(row.ENABLED)) if u['enabled'] is None else u['enabled']})
+                added = [g for g in u['groups'] if not (u['username'].lower(), g.lower()) in granted]
+                grants += [{'USERNAME': u['username'], 'AUTHORITY': g} for g in added]
+                if added:
+                    entry['groups'] = added
+                if row is not None and not entry['changes'] and not added:
+                    result['users_unchanged'] += 1
+                    continue
+                result['diff'].append(entry)
+            result['users_created'] += len(inserts)
+            result['users_updated'] += len(updates)
+            result['grants_added'] += len(grants)
+            if dry_run:
+                continue
+
+            if inserts:
+                db.session.execute(users_table.insert(), inserts)
+            if updates:
+                db.session.execute(users_table.update().where(users_table.c.USERNAME == db.bindparam('b_username')).values(
+                    PASSWORD=db.bindparam('b_password'), DESCRIPTION=db.bindparam('b_description'),
+                    ENABLED=db.bindparam('b_enabled')), updates)
+            if grants:
+                db.session.execute(grants_table.insert(), grants)
+            updated += [u['b_username'] for u in updates]
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for username in updated:
+        user_cache.invalidate(username)
+
+    result['rows'] = len(users)
+    result['seconds'] = round(time.time() - start, 3)
+    result['rows_per_sec'] = round(len(users) / max(time.time() - start, 0.001), 1)
+    result['dry_run'] = dry_run
+    return result
+
+
 SECRET_KEY = "yeah, not actually a secret-less"
 DEBUG = True
 
@@ -103,8 +507,7 @@ login_manager.refresh_view = "reauth"
 
 @login_manager.user_loader
 def load_user(username):
-    u = DBUser.query.get(username)
-    return User(u.USERNAME, u.DESCRIPTION)
+    return user_cache.get(username)
 
 
 login_manager.setup_app(app)
@@ -118,7 +521,12 @@ def index():
 @app.route('/groups')
 @fresh_login_required
 def groups():
-    groups = DBAuthorities.query.all()
+    # every group's member count in one pass over the (AUTHORITY, USERNAME) index
+    sql = db.text("SELECT a.AUTHORITY, a.DESCRIPTION, COUNT(g.USERNAME) AS members \
+                   FROM AUTHORITIES AS a LEFT JOIN GRANTED_AUTHORITIES AS g \
+                   ON g.AUTHORITY = a.AUTHORITY \
+                   GROUP BY a.AUTHORITY, a.DESCRIPTION ORDER BY a.AUTHORITY")
+    groups = db.session.execute(sql).fetchall()
     return render_template('show_groups.html', groups=groups)
 
 @app.route('/add_group', methods=['POST'])
@@ -160,6 +568,51 @@ def edit_group(group):
     return redirect(url_for('groups'))
 
 
+@app.route('/group_members/<group>', methods=['GET', 'POST'])
+@fresh_login_required
+def group_members(group):
+    """A page of a group's users, or add users to (and remove them from) the group
+    in bulk - a JSON body of {"add": [...], "remove": [...]}, or form fields add and
+    remove listing the usernames separated by spaces, commas or new lines."""
+    flask.g.breadcrumb = 'groups'
+    if request.method == "GET":
+        g = DBAuthorities.query.get(group)
+        if not g:
+            flash('Group %s does not exist' % group)
+            return redirect(url_for('groups'))
+        members, after, search = member_page(group, request.args)
+        total = db.session.query(db.func.count(DBGrantedAuthorities.USERNAME)).filter(
+            DBGrantedAuthorities.AUTHORITY == group).scalar()
+        return render_template('group_members.html', group=g, members=members, total=total,
+                               after=after, search=search)
+    data = request.get_json(silent=True) if request.mimetype == 'application/json' else None
+    if data is not None:
+        if not isinstance(data, dict) or not all(isinstance(data.get(k, []), list) for k in ('add', 'remove')):
+            return flask.jsonify(error='expected {"add": [...], "remove": [...]}'), 400
+        add, remove = data.get('add', []), data.get('remove', [])
+    else:
+        add, remove = [request.form.get(k, '').replace(',', ' ').split() for k in ('add', 'remove')]
+    if not DBAuthorities.query.get(group):
+        if data is not None:
+            return flask.jsonify(error='group %s does not exist' % group), 404
+        flash('Group %s does not exist' % group)
+        return redirect(url_for('groups'))
+
+    # grants for users that do not exist are left out
+    known = set()
+    if add:
+        known.update(r[0] for r in db.session.execute(
+            db.select([DBUser.USERNAME]).where(DBUser.USERNAME.in_(sorted(set(add))))))
+    unknown = sorted(set(add) - known)
+    added, removed = update_grants(group=group, add=known, remove=remove)
+    db.session.commit()
+    if data is not None:
+        return flask.jsonify(added=added, removed=removed, unknown=unknown)
+    flash('Group %s: %d users added, %d removed' % (group, len(added), len(removed)) +
+          ('' if not unknown else ' - unknown users: ' + ', '.join(unknown)))
+    return redirect(url_for('group_members', group=group))
+
+
 @app.route('/delete_group/<group>', methods=['GET', 'POST'])
 @fresh_login_required
 def delete_group(group):
@@ -183,8 +636,39 @@ def delete_group(group):
 @app.route('/users')
 @fresh_login_required
 def users():
-    users = DBUser.query.all()
-    return render_template('show_users.html', users=users)
+    users, after, settings = user_page(request.args)
+    return render_template('show_users.html', users=users, after=after, search=settings)
+
+
+@app.route('/users.json')
+@fresh_login_required
+def users_json():
+    users, after, settings = user_page(request.args)
+    return flask.jsonify(users=[{'username': u.USERNAME, 'description': u.DESCRIPTION,
+                                 'enabled': is_enabled(u.ENABLED)} for u in users],
+                         next=url_for('users_json', after=after, **settings) if after else None,
+                         after=after)
+
+@app.route('/import', methods=['POST'])
+@fresh_login_required
+def import_file():
+    """Import users from an uploaded file (field "file") or the request body - JSON
+    when the file name or Content-Type says so, otherwise CSV.  ?dry_run=1 only
+    returns the diff."""
+    upload = request.files.get('file')
+    if upload:
+        fh, format = upload.stream, 'json' if upload.filename.lower().endswith('.json') else 'csv'
+    else:
+        fh, format = request.stream, 'json' if request.mimetype == 'application/json' else 'csv'
+    dry_run = request.values.get('dry_run', '') in ('1', 'true', 'yes', 'on')
+    try:
+        result = import_users(read_import(fh, format), dry_run)
+    except (ValueError, KeyError, TypeError, csv.Error) as e:
+        return flask.jsonify(error=str(e)), 400
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        return flask.jsonify(error='database error: %s' % str(e)), 500
+    return flask.jsonify(**result)
+
 
 @app.route('/delete_user/<user>', methods=['GET', 'POST'])
 @fresh_login_required
@@ -202,12 +686,24 @@ def delete_user(user):
                     db.session.delete(a)
                 db.session.delete(u)
                 db.session.commit()
+                user_cache.invalidate(user)
                 flash('User %s deleted' % user)
             else:
                 flash('User delete cancelled')
     return redirect(url_for('users'))
 
 
+def user_groups(user):
+    """Every group, and whether the user is in it - the user's grants are looked up
+    by primary key in the join itself."""
+    sql = db.text("SELECT a.AUTHORITY, a.DESCRIPTION, \
+                   IF(g.AUTHORITY IS NULL, 0, 1) AS enabled \
+                   FROM AUTHORITIES AS a LEFT JOIN GRANTED_AUTHORITIES AS g \
+                   ON g.AUTHORITY = a.AUTHORITY AND g.USERNAME = :user \
+                   ORDER BY a.AUTHORITY")
+    return db.session.execute(sql, {"user": user}).fetchall()
+
+
 @app.route('/edit_user/<user>', methods=['GET', 'POST'])
 @fresh_login_required
 def edit_user(user):
@@ -217,13 +713,7 @@ def edit_user(user):
         flash('User %s does not exist' % user)
     else:
         if request.method == "GET":
-            sql = db.text("SELECT a.AUTHORITY, a.DESCRIPTION, \
-                   IF(t.AUTHORITY IS NULL, 0, 1) AS enabled \
-                   FROM AUTHORITIES AS a LEFT JOIN \
-                    (SELECT AUTHORITY FROM GRANTED_AUTHORITIES WHERE USERNAME = :user ) AS t \
-                   ON a.AUTHORITY = t.AUTHORITY")
-            groups = db.session.execute(sql, {"user": user}).fetchall()
-            return render_template('edit_user.html', user=u, groups=groups)
+            return render_template('edit_user.html', user=u, groups=user_groups(user))
         else:
             if request.form['doit']=='Save':
                 u.DESCRIPTION = request.form["description"]
@@ -238,14 +728,10 @@ def edit_user(user):
                 else:
                     if len(new1) > 0 or len(new2) > 0:
                         flash('Password invalid')
-                        return render_template('edit_user.html', user=u)
-                for a in DBGrantedAuthorities.query.filter_by(USERNAME=user):
-                   db.session.delete(a)
-                authorities = request.form.getlist("groups")
-                for authority in authorities:
-                    a = DBGrantedAuthorities(user, authority)
-                    db.session.add(a)
+                        return render_template('edit_user.html', user=u, groups=user_groups(user))
+                update_grants(user=user, replace=request.form.getlist("groups"))
                 db.session.commit()
+                user_cache.invalidate(user)
                 flash('User %s saved' % user)
             else:
                 flash('User edit cancelled')
@@ -279,6 +765,7 @@ def register():
         else:
             db.session.add(user)
             db.session.commit()
+            user_cache.invalidate(user.USERNAME)
             flash("User created! Now set the groups.")
             return redirect(url_for('edit_user', user=user.USERNAME))
 
@@ -329,6 +816,39 @@ def logout():
     return redirect(url_for("index"))
 
 if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--create-indexes", dest="create_indexes", default=False, action="store_true",
+                      help="Add the indexes the user manager needs to the hibernate tables")
+    parser.add_option("--import", dest="import_file", default=None, type="string",
+                      help="Import users from a CSV or JSON file (- for stdin)", metavar="FILE")
+    parser.add_option("--format", dest="format", default=None, type="choice", choices=['csv', 'json'],
+                      help="Format of the import file - csv or json (default from the file name)", metavar="FORMAT")
+    parser.add_option("--dry-run", dest="dry_run", default=False, action="store_true",
+                      help="Show what the import would change without changing anything")
+    parser.add_option("--chunk", dest="chunk", default=IMPORT_CHUNK, type="int",
+                      help="Users imported in each transaction", metavar="USERS")
+    (options, args) = parser.parse_args()
+
+    if options.create_indexes:
+        created = create_indexes()
+        print('created indexes: ' + (', '.join(created) or 'none'))
+        sys.exit(0)
+    if options.import_file:
+        format = options.format or ('json' if options.import_file.lower().endswith('.json') else 'csv')
+        fh = sys.stdin if options.import_file == '-' else open(options.import_file, 'rb')
+        try:
+            with app.app_context():
+                result = import_users(read_import(fh, format), options.dry_run, max(options.chunk, 1))
+        except (ValueError, KeyError, TypeError, csv.Error, sqlalchemy.exc.SQLAlchemyError) as e:
+            sys.stderr.write('import failed: %s\n' % str(e))
+            sys.exit(1)
+        for entry in result['diff']:
+            print(json.dumps(entry, sort_keys=True))
+        print('%s%d users created, %d updated, %d unchanged, %d groups created, %d grants added, %d errors - %d rows in %.3fs (%.1f rows/sec)' %
+              ('dry run: ' if options.dry_run else '', result['users_created'], result['users_updated'],
+               result['users_unchanged'], result['groups_created'], result['grants_added'], result['errors'],
+               result['rows'], result['seconds'], result['rows_per_sec']))
+        sys.exit(1 if result['errors'] else 0)
     app.run()
 
 application = app